@@ -0,0 +1,239 @@
+'''
+End-to-end benchmarks for the song maker and the song service. Every benchmark
+runs with a fixed seed in a forked child process, and reports percentiles of
+its run times, the child's peak resident memory and how much the benchmark
+grew it. Results can be saved as JSON and compared against a saved baseline,
+for example:
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --baseline baseline.json
+
+Exits with status 1 when a benchmark's median time or its memory growth is
+more than --tolerance above the baseline's.
+'''
+
+import argparse
+import json
+import os
+import pickle
+import random
+import resource
+import sys
+import time
+import traceback
+
+import songmaker
+import songservice
+
+# memory growth differences smaller than this are noise
+MEMORY_NOISE_KB = 1024
+
+
+def percentile(sorted_times, fraction):
+    ''' Nearest-rank percentile of an already sorted list '''
+    index = int(round(fraction * (len(sorted_times) - 1)))
+    return sorted_times[index]
+
+
+def summarise(times):
+    sorted_times = sorted(times)
+    return {
+        'iterations': len(times),
+        'mean': sum(times) / len(times),
+        'p50': percentile(sorted_times, 0.5),
+        'p90': percentile(sorted_times, 0.9),
+        'p99': percentile(sorted_times, 0.99),
+        'max': sorted_times[-1],
+    }
+
+
+def get_memory_kb():
+    '''
+    Returns (current, peak) resident memory in kilobytes. Without /proc both
+    are the peak over the process's life
+    '''
+    try:
+        with open('/proc/self/status', 'r') as status_file:
+            fields = dict(line.split(':', 1) for line in status_file)
+        return int(fields['VmRSS'].split()[0]), int(fields['VmHWM'].split()[0])
+    except (IOError, KeyError):
+        # ru_maxrss is in kilobytes on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak, peak
+
+
+def reset_peak_memory():
+    ''' Makes the peak resident memory start again from the current, where Linux allows it '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except IOError:
+        pass
+
+
+def measure(func, iterations):
+    ''' Times func and records how far it pushes resident memory above where it started '''
+    reset_peak_memory()
+    start_kb = get_memory_kb()[0]
+    summary = summarise(time_calls(func, iterations))
+    summary['peak_rss_kb'] = get_memory_kb()[1]
+    summary['memory_kb'] = summary['peak_rss_kb'] - start_kb
+    return summary
+
+
+def run_in_child(func):
+    '''
+    Calls func in a forked child process and returns its result, so each
+    benchmark's memory is measured on its own and nothing it allocates stays
+    '''
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            result = func()
+        except BaseException:
+            result = traceback.format_exc()
+            status = 1
+        with os.fdopen(write_fd, 'wb') as result_file:
+            pickle.dump(result, result_file)
+        os._exit(status)
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as result_file:
+        result = pickle.load(result_file)
+    status = os.waitpid(pid, 0)[1]
+    if status != 0:
+        raise RuntimeError('benchmark failed in its child process:\n%s' % result)
+    return result
+
+
+def time_calls(func, iterations):
+    ''' Calls func iterations times, returning the seconds each call took '''
+    times = []
+    for i in xrange(iterations):
+        start_time = time.time()
+        func()
+        times.append(time.time() - start_time)
+    return times
+
+
+def run_benchmarks(args):
+    ''' Runs every benchmark, returning a map of benchmark name to its summary '''
+    results = {}
+    def benchmark(name, func, iterations):
+        def run():
+            random.seed(args.seed)
+            return measure(func, iterations)
+        results[name] = run_in_child(run)
+        print ('%-40s p50 %9.6fs  p90 %9.6fs  p99 %9.6fs  max %9.6fs  '
+            'peak %7d KB  grew %7d KB') % (
+            name, results[name]['p50'], results[name]['p90'], results[name]['p99'],
+            results[name]['max'], results[name]['peak_rss_kb'], results[name]['memory_kb'])
+
+    def parse_text():
+        reader = songmaker.Reader(songmaker.open_corpus(args.source_text))
+        reader.parse_text()
+    benchmark('parse_text', parse_text, args.repeat)
+
+    reader = songmaker.Reader(songmaker.open_corpus(args.source_text))
+    reader.parse_text()
+    generator = songmaker.WordGenerator(reader, args.min, args.max, allow_doubles=False)
+    benchmark('generate_words', lambda: generator.generate_words(args.num_words), args.repeat)
+    benchmark('generate_word_pool', lambda: songmaker.generate_word_pool(
+        generator, args.num_words, args.seed, args.workers), args.repeat)
+    benchmark('generate_covering_pool', lambda: songmaker.generate_covering_pool(
+        generator, songservice.WORD_POOL_RHYME_GROUPS, args.num_words, seed=args.seed),
+        args.repeat)
+
+    words = songmaker.generate_word_pool(generator, args.num_words, args.seed, 1)
+    for trie_class in (songmaker.TrieNode, songmaker.SortedTrie):
+        def build_trie():
+            trie = trie_class()
+            for word in words:
+                trie.add_letters(word[::-1])
+            return trie
+        benchmark('%s construction' % trie_class.__name__, build_trie, args.repeat)
+        results['%s construction' % trie_class.__name__]['size_bytes'] = (
+            songmaker.get_trie_size(build_trie()))
+
+    benchmark('construct_maps', lambda: songmaker.SongWriter(words).construct_maps(),
+        args.repeat)
+
+    song_writer = songmaker.SongWriter(words)
+    song_writer.construct_maps()
+    for scheme, min_syllables, max_syllables in songservice.PRESET_SCHEMES:
+        benchmark('get_song %s' % scheme, lambda: song_writer.get_song(
+            scheme, min_syllables, max_syllables), args.iterations)
+
+    # the endpoint goes through the Flask test client, without the song buffer thread.
+    # It always asks for the MIN_LETTERS to MAX_LETTERS model, so that key serves
+    # the model built above whatever --min and --max are
+    model_key = (songservice.DEFAULT_CORPUS, songservice.MIN_LETTERS, songservice.MAX_LETTERS)
+    songservice.models.add(model_key, song_writer)
+    client = songservice.app.test_client()
+    for scheme, min_syllables, max_syllables in songservice.PRESET_SCHEMES:
+        url = '/?scheme=%s&minSyllables=%s&maxSyllables=%s&corpus=%s' % (
+            scheme, min_syllables, max_syllables, songservice.DEFAULT_CORPUS)
+        benchmark('endpoint %s' % scheme, lambda: client.get(url), args.iterations)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Returns the names of the benchmarks whose median time or memory growth
+    regressed beyond tolerance
+    '''
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        result, expected = results[name], baseline[name]
+        ratio = result['p50'] / max(expected['p50'], 1e-9)
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            print 'REGRESSION %s: p50 %.6fs vs %.6fs baseline (%.0f%% slower)' % (
+                name, result['p50'], expected['p50'], (ratio - 1) * 100)
+        if 'memory_kb' not in result or 'memory_kb' not in expected:
+            continue
+        limit = max(expected['memory_kb'] * (1 + tolerance),
+            expected['memory_kb'] + MEMORY_NOISE_KB)
+        if result['memory_kb'] > limit:
+            if name not in regressions:
+                regressions.append(name)
+            print 'REGRESSION %s: grew memory %d KB vs %d KB baseline' % (
+                name, result['memory_kb'], expected['memory_kb'])
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source-text', default='eightydays.txt',
+        help='The source text to extract letter frequency data from')
+    parser.add_argument('--min', type=int, default=songservice.MIN_LETTERS,
+        help='Minimum number of letters in words')
+    parser.add_argument('--max', type=int, default=songservice.MAX_LETTERS,
+        help='Maximum number of letters in words')
+    parser.add_argument('-n', '--num-words', type=int, default=songservice.WORD_POOL_SIZE,
+        help='Number of words in the song pool')
+    parser.add_argument('--workers', type=int, help='Processes for generate_word_pool')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for every benchmark')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='Iterations of the corpus, pool and map building benchmarks')
+    parser.add_argument('--iterations', type=int, default=1000,
+        help='Iterations of the song and endpoint benchmarks')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare the results with this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help='Fraction a median may be slower than the baseline before it is flagged')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
@@ -0,0 +1,105 @@
+'''
+Minimal in-process metrics, rendered in the Prometheus text format. Recording
+a value is a dict update under a lock; nothing else happens until a scrape
+calls render()
+'''
+
+import bisect
+import threading
+
+
+# seconds, from a fast get_song to a slow model build
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+all_metrics = []
+
+
+def format_labels(label_names, label_values, extra=()):
+    pairs = zip(label_names, label_values) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('"', '\\"'))
+        for name, value in pairs)
+
+
+class Metric(object):
+    ''' Base for a named metric whose values are kept per tuple of label values '''
+    metric_type = None
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+        all_metrics.append(self)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.description),
+            '# TYPE %s %s' % (self.name, self.metric_type)]
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            lines.extend(self.render_value(label_values, value))
+        return lines
+
+    def render_value(self, label_values, value):
+        return ['%s%s %s' % (self.name, format_labels(self.label_names, label_values),
+            repr(float(value)))]
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    ''' Counts observations into buckets, keeping their sum and count '''
+    metric_type = 'histogram'
+
+    def __init__(self, name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, description, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if labels not in self.values:
+                # one count per bucket plus +Inf, then the sum
+                self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts = self.values[labels]
+            counts[index] += 1
+            counts[-1] += value
+
+    def render_value(self, label_values, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append('%s_bucket%s %s' % (self.name,
+                format_labels(self.label_names, label_values, [('le', le)]), cumulative))
+        labels = format_labels(self.label_names, label_values)
+        lines.append('%s_sum%s %s' % (self.name, labels, repr(counts[-1])))
+        lines.append('%s_count%s %s' % (self.name, labels, cumulative))
+        return lines
+
+
+def render():
+    ''' All metrics in the Prometheus text exposition format '''
+    lines = []
+    for metric in all_metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
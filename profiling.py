@@ -0,0 +1,75 @@
+'''
+Profiling helpers. StackSampler samples the main thread's stack on a CPU time
+timer and writes folded stacks for flame graph tools, write_profile saves a
+cProfile run as pstats, and dump_request_profile keeps the latest few request
+profiles in a directory
+'''
+
+import collections
+import os
+import pstats
+import signal
+import time
+
+
+class StackSampler(object):
+    '''
+    Records the main thread's stack every interval seconds of CPU time. Only
+    works in the main thread, signals are always handled there
+    '''
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.stacks = collections.Counter()
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%s)' % (
+                code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def write(self, path):
+        ''' Writes a "frame;frame;frame count" line per stack, as flamegraph.pl reads '''
+        with open(path, 'w') as folded_file:
+            for stack, count in sorted(self.stacks.iteritems()):
+                folded_file.write('%s %s\n' % (stack, count))
+
+
+def write_profile(profiler, path):
+    '''
+    Writes a stopped cProfile.Profile to path as pstats, and a summary of the
+    functions taking the most cumulative time to path.txt
+    '''
+    profiler.dump_stats(path)
+    with open(path + '.txt', 'w') as summary_file:
+        stats = pstats.Stats(path, stream=summary_file)
+        stats.sort_stats('cumulative').print_stats(50)
+
+
+def dump_request_profile(profiler, directory, name, max_files):
+    '''
+    Saves a request's profile to directory, deleting the oldest profiles so
+    there are never more than max_files
+    '''
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # names start with the time, so they sort oldest first
+    file_name = '%.6f-%s.pstats' % (time.time(), name)
+    profiler.dump_stats(os.path.join(directory, file_name))
+    dumps = sorted(f for f in os.listdir(directory) if f.endswith('.pstats'))
+    for old_dump in dumps[:-max_files]:
+        try:
+            os.remove(os.path.join(directory, old_dump))
+        except OSError:
+            # another thread got to it first
+            pass
@@ -4,22 +4,60 @@ but realised it's not necessary and all I need is a reverse Trie to look up suff
 '''
 
 import argparse
+import atexit
+import bisect
 import collections
-import datetime
+import cProfile
+import gzip
 import itertools
+import json
 import logging
 import math
+import metrics
+import mmap
+import multiprocessing
+import os
+import profiling
 import random
 import re
 import string
 import StringIO
+import struct
 import sys
+import tempfile
+import threading
+import time
 import unittest
 
 
 LOWER_CASE_LETTERS = string.lowercase
 VOWELS = 'aeiouy'
 CONSONANTS = ''.join([l for l in LOWER_CASE_LETTERS if l not in VOWELS])
+CHUNK_SIZE = 1024 * 1024
+DOUBLE_SYLLABLES = frozenset(['ui', 'ia', 'ea', 'io'])
+SYLLABLE_CACHE_SIZE = 100000
+
+words_generated = metrics.Counter(
+    'songmaker_words_generated_total', 'Words made by WordGenerator')
+songs_written = metrics.Counter('songmaker_songs_written_total', 'Songs written by SongWriter')
+songs_rejected = metrics.Counter('songmaker_songs_rejected_total',
+    'Songs SongWriter could not write, by reason', ['reason'])
+song_retries = metrics.Counter('songmaker_song_retries_total',
+    'Songs SongWriter started again after running out of rhyme groups')
+song_seconds = metrics.Histogram('songmaker_song_seconds', 'Time taken to compose a song')
+rhyme_group_scans = metrics.Counter('songmaker_rhyme_group_scans_total',
+    'Rhymes that had to scan the eligible rhyme groups for a middle length rhyme word')
+construct_maps_seconds = metrics.Gauge(
+    'songmaker_construct_maps_seconds', 'Time the last SongWriter.construct_maps took')
+
+# snapshot layout: header, word offsets, bucket directory, word ids, word text.
+# Everything is little-endian uint32 so it can be read in place from a mmap
+SNAPSHOT_VERSION = 1
+SNAPSHOT_MAGIC = 'SONGMDL%s' % SNAPSHOT_VERSION
+SNAPSHOT_HEADER = struct.Struct('<8sIIII')
+SNAPSHOT_BUCKET = struct.Struct('<IIII')
+SNAPSHOT_UINT = struct.Struct('<I')
+SNAPSHOT_ALL_WORDS = 0xFFFFFFFF
 
 
 class TrieNode(object):
@@ -97,26 +135,238 @@ class TrieNode(object):
         return set(matches)
 
 
-def count_syllables(word):
-    # find all groups of vowels followed by one or more consonants
-    # todo: look backwards on word boundary and take all vowels. BOOYAH
-    regex = r'[{vowels}]+(?=[{consonants}]*)'.format(
-        vowels=VOWELS, consonants=CONSONANTS)
-    vowel_groups = re.findall(regex, word)
-    syllables = len(vowel_groups)
-    # no vowels, fuck this!
-    if syllables == 0:
-        return 0
+class SortedTrie(object):
+    '''
+    A compact alternative to TrieNode with the same interface. Words are kept in
+    a single sorted list and a prefix lookup is two binary searches, rather than
+    allocating an object and a dict for every letter of every word
+    '''
+
+    def __init__(self):
+        self.words = []
+        self.is_sorted = False
+
+    def add_letters(self, letters):
+        '''
+        Adds letters to the trie. While the trie is being filled sorting is
+        deferred until the next lookup, after that letters are inserted in place
+        '''
+        if not self.is_sorted:
+            self.words.append(letters)
+            return
+        index = bisect.bisect_left(self.words, letters)
+        if index == len(self.words) or self.words[index] != letters:
+            self.words.insert(index, letters)
+
+    def remove_letters(self, letters):
+        ''' Removes letters from the trie if they were added '''
+        words = self.get_sorted_words()
+        index = bisect.bisect_left(words, letters)
+        if index < len(words) and words[index] == letters:
+            del words[index]
+
+    def get_sorted_words(self):
+        if not self.is_sorted:
+            self.words = sorted(set(self.words))
+            self.is_sorted = True
+        return self.words
+
+    def prefix_range(self, prefix):
+        ''' Returns the (start, end) indices of the sorted words starting with prefix '''
+        words = self.get_sorted_words()
+        if not prefix:
+            return 0, len(words)
+        start = bisect.bisect_left(words, prefix)
+        # the smallest string that sorts after every string starting with prefix
+        upper_bound = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        end = bisect.bisect_left(words, upper_bound, start)
+        return start, end
+
+    def words_with_prefix(self, prefix, reverse=False):
+        ''' Returns a list of words with a given prefix '''
+        start, end = self.prefix_range(prefix)
+        words_with_prefix = self.words[start:end]
+        if reverse:
+            words_with_prefix = [w[::-1] for w in words_with_prefix]
+        return words_with_prefix
+
+    def get_all_prefixes(self, num_syllables, reverse=False):
+        '''
+        Gets all shortest prefixes with num_syllables in this trie, the same set
+        TrieNode.get_all_prefixes returns.
+        Reverse means reverse the prefix before checking the syllable count
+        in case this is a suffix-ordered trie.
+        '''
+        def prefix_matcher(prefix):
+            if reverse:
+                prefix = prefix[::-1]
+            return count_syllables(prefix) == num_syllables
+        if prefix_matcher(''):
+            return set([''])
+        prefixes = set()
+        last_match = None
+        previous_word = ''
+        for word in self.get_sorted_words():
+            # words under an already matched prefix are in the same subtree
+            if last_match is not None and word.startswith(last_match):
+                continue
+            # prefixes shared with the previous word are already known not to match
+            common = 0
+            for a, b in itertools.izip(previous_word, word):
+                if a != b:
+                    break
+                common += 1
+            for length in xrange(common + 1, len(word) + 1):
+                if prefix_matcher(word[:length]):
+                    last_match = word[:length]
+                    prefixes.add(last_match)
+                    break
+            previous_word = word
+        return prefixes
+
+    def get_all_words(self):
+        ''' Returns all the words contained in this trie '''
+        return set(self.get_sorted_words())
+
+
+def scan_syllables(word):
+    '''
+    Counts the syllables in word in a single pass: every group of vowels is a
+    syllable, the double syllable groups count twice and a single 'e' ending
+    the word doesn't count
+    '''
+    syllables = 0
+    vowel_group = ''
+    for letter in word:
+        if letter in VOWELS:
+            vowel_group += letter
+        elif vowel_group:
+            syllables += 2 if vowel_group in DOUBLE_SYLLABLES else 1
+            vowel_group = ''
     # if the last vowel group is a single 'e', it's probably not a syllable
     # if it's a single other vowel or multiple vowels it probably is a syllable
-    if vowel_groups[-1] == 'e' and word[-1] in VOWELS:
-        syllables -= 1
-    # count the double syllables and increase the syllable count for each
-    doubles = ['ui', 'ia', 'ea', 'io']
-    syllables += len([v for v in vowel_groups if v in doubles])
+    if vowel_group and vowel_group != 'e':
+        syllables += 2 if vowel_group in DOUBLE_SYLLABLES else 1
     return syllables
 
 
+class SyllableCache(object):
+    '''
+    Memoizes scan_syllables in two generations. New counts go into the current
+    generation and when that fills up it replaces the previous one, so at most
+    2 * size words are held and recently used words survive the eviction
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.current = {}
+        self.previous = {}
+
+    def get(self, word):
+        try:
+            return self.current[word]
+        except KeyError:
+            pass
+        syllables = self.previous.get(word)
+        if syllables is None:
+            syllables = scan_syllables(word)
+        if len(self.current) >= self.size:
+            self.previous = self.current
+            self.current = {}
+        self.current[word] = syllables
+        return syllables
+
+
+syllable_cache = SyllableCache(SYLLABLE_CACHE_SIZE)
+
+
+def count_syllables(word):
+    return syllable_cache.get(word)
+
+
+def count_syllables_batch(words):
+    ''' Returns the syllable counts of words, counting each distinct word once '''
+    get = syllable_cache.get
+    counts = dict((word, get(word)) for word in set(words))
+    return [counts[word] for word in words]
+
+
+def parse_rhyming_scheme(rhyming_scheme):
+    ''' 
+    Rhyming scheme is of the form N:X, where N is number of syllables in the line
+    and X is the type of rhyme. For example the rhyming scheme for a limerick is:
+    8a,8a,5b,5b,8a
+    Returns a list of tuples of the form [(syllables, rhyme), ...]
+    '''
+    split_regex = r'([0-9]+)([a-z]),?'
+    lines = re.findall(split_regex, rhyming_scheme)
+    return [(int(line[0]), line[1]) for line in lines]
+
+
+def get_rhyme_suffix(word):
+    '''
+    Returns the shortest suffix of word that has one syllable, or None if there
+    isn't one. Words with the same rhyme suffix rhyme with each other
+    '''
+    # consonants add no syllables, so the shortest suffix starts on a vowel. It's
+    # almost always the last one, the second last when the word ends on an 'e'
+    for start in xrange(len(word) - 1, -1, -1):
+        if word[start] in VOWELS and scan_syllables(word[start:]) == 1:
+            return word[start:]
+    return None
+
+
+
+def open_corpus(path):
+    '''
+    Opens a source text for a Reader. Gzipped files are decompressed as they're
+    read, anything else is memory-mapped so large corpora aren't copied into memory
+    '''
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    with open(path, 'rb') as corpus_file:
+        if os.fstat(corpus_file.fileno()).st_size == 0:
+            return StringIO.StringIO('')
+        return mmap.mmap(corpus_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def read_chunks(text, chunk_size=CHUNK_SIZE):
+    '''
+    Reads a file-like object in chunks of about chunk_size bytes, each ending
+    on a non-letter so words are never split between chunks
+    '''
+    carry = ''
+    while True:
+        data = text.read(chunk_size)
+        if not data:
+            break
+        chunk = carry + data
+        split = re.search('[^a-zA-Z][a-zA-Z]*$', chunk)
+        if split is None:
+            carry = chunk
+            continue
+        carry = chunk[split.start() + 1:]
+        yield chunk[:split.start() + 1]
+    if carry:
+        yield carry
+
+
+def count_letters(text):
+    '''
+    Counts, for the words in text, how often each letter is followed by each other
+    letter and how often it appears at each position. Returns (followers, positions)
+    Counters keyed by two letter strings and (letter, position) tuples
+    '''
+    followers = collections.Counter()
+    positions = collections.Counter()
+    # most words repeat a lot, so count every distinct word once
+    word_counts = collections.Counter(re.findall('[a-z]+', text.lower()))
+    for word, count in word_counts.iteritems():
+        for i, letter in enumerate(word):
+            positions[(letter, i)] += count
+        for i in xrange(len(word) - 1):
+            followers[word[i:i + 2]] += count
+    return followers, positions
+
 
 class Letter(object):
     ''' 
@@ -148,16 +398,53 @@ class Reader(object):
         for letter in LOWER_CASE_LETTERS: 
             self.letters[letter] = Letter(letter)
 
-    def parse_text(self):
-        for line in self.text:
-            # lower and strip everything except letters
-            line = line.lower()
-            words = re.findall('[a-z]+', line)
-            for word in words:
-                for i, letter in enumerate(word):
-                    if i+1 < len(word):
-                        self.letters[letter].add_follower(word[i+1])
-                    self.letters[letter].add_position(i)
+    def parse_text(self, num_workers=1, chunk_size=CHUNK_SIZE):
+        '''
+        Counts letter statistics a chunk_size chunk at a time. With more than one
+        worker the chunks are counted in a process pool and the partial counts merged
+        '''
+        chunks = read_chunks(self.text, chunk_size)
+        if num_workers == 1:
+            for followers, positions in itertools.imap(count_letters, chunks):
+                self.add_counts(followers, positions)
+            return
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            for followers, positions in pool.imap_unordered(count_letters, chunks):
+                self.add_counts(followers, positions)
+        finally:
+            pool.close()
+            pool.join()
+
+    def add_counts(self, followers, positions):
+        ''' Merges counts from count_letters into the letter statistics '''
+        for pair, count in followers.iteritems():
+            self.letters[pair[0]].followers[pair[1]] += count
+        for (letter, position), count in positions.iteritems():
+            self.letters[letter].positions[position] += count
+
+    def save_counts(self, path):
+        ''' Writes the letter statistics to a JSON file so load_counts can reuse them '''
+        counts = {'followers': {}, 'positions': {}}
+        for letter in self.letters.values():
+            counts['followers'][letter.letter] = letter.followers
+            counts['positions'][letter.letter] = letter.positions
+        with open(path, 'w') as counts_file:
+            json.dump(counts, counts_file, sort_keys=True)
+
+    def load_counts(self, path):
+        ''' Adds the letter statistics saved by save_counts, instead of parsing text '''
+        with open(path, 'r') as counts_file:
+            counts = json.load(counts_file)
+        followers = collections.Counter()
+        positions = collections.Counter()
+        for letter, letter_followers in counts['followers'].iteritems():
+            for follower, count in letter_followers.iteritems():
+                followers[str(letter + follower)] += count
+        for letter, letter_positions in counts['positions'].iteritems():
+            for position, count in letter_positions.iteritems():
+                positions[(str(letter), int(position))] += count
+        self.add_counts(followers, positions)
 
     def letters_at_position(self, position, num_letters):
         ''' 
@@ -209,82 +496,455 @@ class WordGenerator(object):
             invalid_end_regexes))
         logging.debug('combined reject regexes: %s' % concatenated_reject_patterns)
         self.reject_patterns = re.compile(concatenated_reject_patterns)
+        # the same rules as letter pairs and a consonant run limit, for compile_tables.
+        # The mid patterns all contain three consonants in a row, so the run limit
+        # covers them, and an end pattern can only be extended once it's allowed,
+        # so it's forbidden anywhere in the word
+        self.invalid_start_pairs = set(invalid_start_patterns)
+        self.invalid_pairs = set(invalid_end_patterns)
+        self.max_consonant_run = 2
+        self.compile_tables()
 
-    def generate_word(self):
-        word_length = random.randint(self.min_letters, self.max_letters)
-        logging.debug('making a word %s letters long' % word_length)
-        word = random.choice(self.reader.letters_at_position(0, self.start_letters))
-        logging.debug('first letter is %s, chosen from %s' % (
-            word, self.reader.letters_at_position(0, self.start_letters)))
-        while len(word) < word_length:
-            logging.debug('word is currently %s' % word)
-            frequent_followers = self.reader.following_letters(word[-1], self.follower_count)
-            logging.debug('frequent followers of %s are %s' % (word[-1], frequent_followers))
-            if not self.allow_doubles:
-                try:
-                    frequent_followers.remove(word[-1]) # prevent doubles
-                except ValueError:
-                    pass
-            most_likely_at_position = self.reader.specific_letters_at_position(
-                position=len(word), letters=frequent_followers)[:self.position_limit]
-            logging.debug('the letters most likely at this position are %s' % (
-                most_likely_at_position))
-            next_letter = random.choice(most_likely_at_position)
-            # check for disallowed patterns
-            if self.reject_patterns.search(word + next_letter):
-                logging.debug('word "%s" failed' % (word + next_letter))
+    def compile_tables(self):
+        '''
+        Precomputes the candidate letters for every (previous letter, position) pair
+        from the reader's statistics, so words can be generated without re-sorting
+        the letter frequencies for every character
+        '''
+        self.first_letters = self.reader.letters_at_position(0, self.start_letters)
+        self.candidates = {}
+        for position in range(1, self.max_letters):
+            letters_at_position = self.reader.letters_at_position(position, 26)
+            for letter in LOWER_CASE_LETTERS:
+                frequent_followers = self.reader.following_letters(letter, self.follower_count)
+                if not self.allow_doubles and letter in frequent_followers:
+                    frequent_followers.remove(letter) # prevent doubles
+                most_likely_at_position = [
+                    l for l in letters_at_position if l in frequent_followers]
+                self.candidates[(letter, position)] = (
+                    most_likely_at_position[:self.position_limit])
+        logging.debug('first letters are chosen from %s' % self.first_letters)
+        self.compile_transitions()
+
+    def get_allowed_letters(self, letter, consonant_run, position):
+        '''
+        The candidates that can follow letter at position without breaking a
+        reject rule, as (letter, consonant run) pairs
+        '''
+        allowed = []
+        for next_letter in self.candidates[(letter, position)]:
+            if next_letter in CONSONANTS:
+                next_run = consonant_run + 1
+                if next_run > self.max_consonant_run:
+                    continue
             else:
-                word += next_letter 
-        return word
+                next_run = 0
+            pair = letter + next_letter
+            if pair in self.invalid_pairs or (position == 1 and pair in self.invalid_start_pairs):
+                continue
+            allowed.append((next_letter, next_run))
+        return allowed
+
+    def compile_transitions(self):
+        '''
+        Builds, for every word length, the letters that can follow each (letter,
+        consonant run, position) and still be finished into a word of that length
+        without breaking a reject rule. Choosing from these is the same as drawing
+        candidates until one passes reject_patterns, except that a word can never
+        get stuck, so every word is made in exactly word_length letter choices
+        '''
+        self.transitions = {}
+        self.first_letters_by_length = {}
+        for word_length in range(self.min_letters, self.max_letters + 1):
+            # states that can reach word_length letters, worked out from the end
+            finishable = set((letter, run) for letter in LOWER_CASE_LETTERS
+                for run in range(self.max_consonant_run + 1))
+            for position in range(word_length - 1, 0, -1):
+                previous_finishable = set()
+                for letter in LOWER_CASE_LETTERS:
+                    for run in range(self.max_consonant_run + 1):
+                        allowed = [state for state in
+                            self.get_allowed_letters(letter, run, position)
+                            if state in finishable]
+                        if allowed:
+                            self.transitions[(letter, run, position, word_length)] = allowed
+                            previous_finishable.add((letter, run))
+                finishable = previous_finishable
+            first_letters = [(letter, 1 if letter in CONSONANTS else 0)
+                for letter in self.first_letters]
+            first_letters = [state for state in first_letters if state in finishable]
+            if not first_letters:
+                raise ValueError('no %s letter words can be made from this text' % word_length)
+            self.first_letters_by_length[word_length] = first_letters
+
+    def __getstate__(self):
+        # the compiled tables are all a generator needs once it's built, so
+        # leave the reader and its source file behind when sent to another process
+        state = dict(self.__dict__)
+        del state['reader']
+        return state
+
+    def generate_word(self, rng=random):
+        return self.generate_words(1, rng)[0]
+
+    def generate_words(self, num_words, rng=random):
+        '''
+        Generates a list of num_words words using the precompiled tables. rng can
+        be a random.Random instance, by default the random module is used
+        '''
+        # bind everything used in the inner loop to locals, this is the hot path
+        # when building a word pool
+        randint = rng.randint
+        choice = rng.choice
+        transitions = self.transitions
+        first_letters_by_length = self.first_letters_by_length
+        min_letters = self.min_letters
+        max_letters = self.max_letters
+        words = []
+        for i in xrange(num_words):
+            word_length = randint(min_letters, max_letters)
+            letter, run = choice(first_letters_by_length[word_length])
+            word = letter
+            for position in xrange(1, word_length):
+                letter, run = choice(transitions[(letter, run, position, word_length)])
+                word += letter
+            words.append(word)
+        words_generated.inc(num_words)
+        return words
+
+
+def generate_words_with_seed(args):
+    ''' Process pool task: generates words with its own seeded random number generator '''
+    generator, num_words, seed = args
+    return generator.generate_words(num_words, random.Random(seed))
+
+
+def generate_word_pool(generator, num_words, seed=None, num_workers=None):
+    '''
+    Generates num_words words split across num_workers processes. Every worker gets
+    its own random number generator, seeded from seed, so a given seed and worker
+    count always produce the same pool. Defaults to one worker per CPU
+    '''
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    seed_rng = random.Random(seed)
+    tasks = []
+    for i in range(num_workers):
+        worker_words = num_words / num_workers + (1 if i < num_words % num_workers else 0)
+        tasks.append((generator, worker_words, seed_rng.getrandbits(64)))
+    if num_workers == 1:
+        return generate_words_with_seed(tasks[0])
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        word_lists = pool.map(generate_words_with_seed, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    return list(itertools.chain.from_iterable(word_lists))
+
+
+def generate_covering_pool(generator, rhyme_groups, max_words, min_syllables=1,
+        max_syllables=4, seed=None, batch_size=1000):
+    '''
+    Generates distinct words until at least rhyme_groups rhyme groups have words
+    of every syllable count from min_syllables to max_syllables, max_words words
+    have been made, or a batch brings no new words. Returns the words in the
+    order they were generated
+    '''
+    rng = random.Random(seed)
+    needed = set(range(min_syllables, max_syllables + 1))
+    syllables_by_suffix = collections.defaultdict(set)
+    covered_groups = 0
+    seen = set()
+    words = []
+    while covered_groups < rhyme_groups and len(words) < max_words:
+        # stop if a whole batch is repeats, the generator may have run out of new words
+        pool_size = len(words)
+        for word in generator.generate_words(batch_size, rng):
+            if word in seen:
+                continue
+            seen.add(word)
+            words.append(word)
+            if len(words) >= max_words:
+                break
+            suffix = get_rhyme_suffix(word)
+            syllables = count_syllables(word)
+            if suffix is None or syllables not in needed:
+                continue
+            group_syllables = syllables_by_suffix[suffix]
+            if syllables not in group_syllables:
+                group_syllables.add(syllables)
+                if len(group_syllables) == len(needed):
+                    covered_groups += 1
+                    if covered_groups >= rhyme_groups:
+                        break
+        if len(words) == pool_size:
+            break
+    logging.debug('%s words cover %s rhyme groups' % (len(words), covered_groups))
+    return words
+
+
+class WordBag(object):
+    '''
+    A list of words that can be passed to random.choice, with constant time
+    append and remove. Removing a word moves the last word into its place, so
+    the order isn't kept. The word positions are only indexed once needed
+    '''
+    def __init__(self, words=()):
+        self.words = list(words)
+        self.positions = None
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getitem__(self, index):
+        return self.words[index]
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def append(self, word):
+        if self.positions is not None:
+            self.positions[word].append(len(self.words))
+        self.words.append(word)
+
+    def remove(self, word):
+        ''' Removes one occurrence of word '''
+        if self.positions is None:
+            self.positions = collections.defaultdict(list)
+            for i, w in enumerate(self.words):
+                self.positions[w].append(i)
+        if word not in self.positions:
+            raise ValueError('%s is not in the bag' % word)
+        indices = self.positions[word]
+        index = indices.pop()
+        if not indices:
+            del self.positions[word]
+        last_index = len(self.words) - 1
+        last_word = self.words.pop()
+        if index != last_index:
+            self.words[index] = last_word
+            last_word_indices = self.positions[last_word]
+            last_word_indices[last_word_indices.index(last_index)] = index
 
 
 class NoValidRhymeGroupsFound(Exception): pass
 
+class ImpossibleRhymingScheme(NoValidRhymeGroupsFound): pass
+
+class DeadlineExceeded(Exception): pass
+
 class SongWriter(object):
     ''' 
-    Uses a reverse Trie to write songs that rhyme by matching end syllables 
+    Writes songs that rhyme by grouping words on their last syllable.
+    Once the maps are constructed writing songs only reads them, so one writer
+    can be shared by many threads as long as each passes in its own rng and
+    nothing calls add_words or remove_words meanwhile
     '''
     def __init__(self, words):
         self.all_words = words
         self.words_by_syllable = None
-        self.trie = None
+        self.rhyme_index = None
+        self.rhyme_groups = None
+        self.eligible_groups = None
+        self.word_counts = None
         self.first_time = True
+        self.construction_lock = threading.Lock()
 
     def get_parsed_rhyming_scheme(self, rhyming_scheme):
-        ''' 
-        Rhyming scheme is of the form N:X, where N is number of syllables in the line
-        and X is the type of rhyme. For example the rhyming scheme for a limerick is:
-        8a,8a,5b,5b,8a
-        Returns a list of tuples of the form [(syllables, rhyme), ...]
-        '''
-        split_regex = r'([0-9]+)([a-z]),?'
-        lines = re.findall(split_regex, rhyming_scheme)
-        return [(int(line[0]), line[1]) for line in lines]
+        return parse_rhyming_scheme(rhyming_scheme)
 
     def get_words_by_syllable(self, words):
         words_by_syllable = collections.defaultdict(list)
-        syllable_word_pairs = zip(map(count_syllables, words), words)
+        syllable_word_pairs = zip(count_syllables_batch(words), words)
         for pair in syllable_word_pairs:
             words_by_syllable[pair[0]].append(pair[1])
         return words_by_syllable
     
     def get_rhyme_groups(self):
-        all_prefixes = self.trie.get_all_prefixes(num_syllables=1, reverse=True)
-        return [self.trie.words_with_prefix(p, reverse=True) for p in all_prefixes]
+        ''' Returns the rhyme groups in a stable order, sorted by rhyme suffix '''
+        return [self.rhyme_index[suffix] for suffix in sorted(self.rhyme_index)]
 
     def construct_maps(self):
         if not self.first_time:
             return
-        self.first_time = False
-        # fill up our trie with reversed words so we can search by suffix 
-        self.trie = TrieNode()
-        for word in self.all_words:
-            self.trie.add_letters(word[::-1])
-        # organise our words into a map of syllables-to-words
-        self.words_by_syllable = self.get_words_by_syllable(self.all_words)
-        # get all rhyme groups and sort them into word-by-syllable maps
-        rhyme_groups = self.get_rhyme_groups()
-        self.rhyme_groups = [self.get_words_by_syllable(g) for g in rhyme_groups]
+        with self.construction_lock:
+            if self.first_time:
+                self.build_maps()
+                # only cleared once the maps are complete, so other threads
+                # never write songs from half built maps
+                self.first_time = False
+
+    def build_maps(self):
+        start_time = time.time()
+        # organise our words into a map of syllables-to-words. Each distinct word
+        # also goes into the syllables-to-words map of its rhyme group, which is
+        # keyed by the word's rhyme suffix, so everything is built in one pass
+        words = self.all_words
+        self.all_words = WordBag()
+        self.words_by_syllable = collections.defaultdict(WordBag)
+        self.rhyme_index = {}
+        self.word_counts = {}
+        for word, syllables in itertools.izip(words, count_syllables_batch(words)):
+            self.add_word(word, syllables)
+        self.rhyme_groups = self.get_rhyme_groups()
+        self.eligible_groups = self.get_eligible_groups()
+        construct_maps_seconds.set(time.time() - start_time)
+
+    def add_word(self, word, syllables=None):
+        '''
+        Adds word to the maps, returning True if it starts a new rhyme group or
+        gives one its first word with this many syllables
+        '''
+        if syllables is None:
+            syllables = count_syllables(word)
+        self.all_words.append(word)
+        self.words_by_syllable[syllables].append(word)
+        count = self.word_counts.get(word, 0)
+        self.word_counts[word] = count + 1
+        # the rhyme groups only hold distinct words
+        if count > 0:
+            return False
+        suffix = get_rhyme_suffix(word)
+        if suffix is None:
+            return False
+        if suffix not in self.rhyme_index:
+            self.rhyme_index[suffix] = collections.defaultdict(WordBag)
+        rhyme_group = self.rhyme_index[suffix]
+        new_syllables = syllables not in rhyme_group
+        rhyme_group[syllables].append(word)
+        return new_syllables
+
+    def remove_word(self, word):
+        '''
+        Removes word from the maps, returning True if it was the last word with
+        this many syllables in its rhyme group
+        '''
+        count = self.word_counts.get(word, 0)
+        if count == 0:
+            raise ValueError('%s is not in the word pool' % word)
+        syllables = count_syllables(word)
+        self.all_words.remove(word)
+        self.remove_from_group(self.words_by_syllable, syllables, word)
+        if count > 1:
+            self.word_counts[word] = count - 1
+            return False
+        del self.word_counts[word]
+        suffix = get_rhyme_suffix(word)
+        if suffix is None:
+            return False
+        rhyme_group = self.rhyme_index[suffix]
+        self.remove_from_group(rhyme_group, syllables, word)
+        if syllables in rhyme_group:
+            return False
+        if not rhyme_group:
+            del self.rhyme_index[suffix]
+        return True
+
+    def get_eligible_groups(self):
+        '''
+        Builds the map of (min, max) syllables to the suffixes of the rhyme groups
+        with words of both lengths. Suffixes are in sorted order, whether the maps
+        were built, updated or loaded, so a seed always picks the same groups
+        '''
+        eligible_groups = collections.defaultdict(WordBag)
+        for suffix in sorted(self.rhyme_index):
+            all_syllables = sorted(self.rhyme_index[suffix])
+            for i, min_syllables in enumerate(all_syllables):
+                for max_syllables in all_syllables[i:]:
+                    eligible_groups[(min_syllables, max_syllables)].append(suffix)
+        return eligible_groups
+
+    def remove_from_group(self, group, syllables, word):
+        ''' Removes word from a syllables-to-words map, dropping empty entries '''
+        group[syllables].remove(word)
+        if not group[syllables]:
+            del group[syllables]
+
+    def add_words(self, words):
+        '''
+        Adds words to the pool, updating the maps in place rather than
+        rebuilding them. A writer loaded from a snapshot is rebuilt in memory first
+        '''
+        self.make_mutable()
+        rhyme_groups_changed = False
+        for word in words:
+            rhyme_groups_changed = self.add_word(word) or rhyme_groups_changed
+        if rhyme_groups_changed:
+            self.rhyme_groups = self.get_rhyme_groups()
+            self.eligible_groups = self.get_eligible_groups()
+
+    def remove_words(self, words):
+        ''' Removes words from the pool, the counterpart of add_words '''
+        self.make_mutable()
+        rhyme_groups_changed = False
+        for word in words:
+            rhyme_groups_changed = self.remove_word(word) or rhyme_groups_changed
+        if rhyme_groups_changed:
+            self.rhyme_groups = self.get_rhyme_groups()
+            self.eligible_groups = self.get_eligible_groups()
+
+    def make_mutable(self):
+        ''' Builds the maps, or rebuilds them in memory if they came from a snapshot '''
+        if self.word_counts is None and not self.first_time:
+            self.all_words = list(self.all_words)
+            self.first_time = True
+        self.construct_maps()
+
+    def save(self, path):
+        ''' Writes the constructed maps to a snapshot file that SongWriter.load can mmap '''
+        self.construct_maps()
+        word_ids = {}
+        offsets = [0]
+        for i, word in enumerate(self.all_words):
+            word_ids.setdefault(word, i)
+            offsets.append(offsets[-1] + len(word))
+        # the pool-wide syllable buckets are stored as group SNAPSHOT_ALL_WORDS
+        groups = [(SNAPSHOT_ALL_WORDS, self.words_by_syllable)]
+        groups += list(enumerate(self.rhyme_groups))
+        buckets = []
+        ids = []
+        for group_index, group in groups:
+            for syllables in sorted(group):
+                start = len(ids)
+                ids.extend(word_ids[w] for w in group[syllables])
+                buckets.append((group_index, syllables, start, len(ids)))
+        # write to a temporary file of our own first, so readers never map a
+        # half-written snapshot even when several processes save at once
+        temp_fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+            prefix=os.path.basename(path) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(temp_fd, 'wb') as snapshot_file:
+                snapshot_file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC,
+                    len(self.all_words), len(ids), len(buckets), len(self.rhyme_groups)))
+                snapshot_file.write(struct.pack('<%sI' % len(offsets), *offsets))
+                for bucket in buckets:
+                    snapshot_file.write(SNAPSHOT_BUCKET.pack(*bucket))
+                snapshot_file.write(struct.pack('<%sI' % len(ids), *ids))
+                snapshot_file.write(''.join(self.all_words))
+            # mkstemp files are only readable by their owner
+            os.chmod(temp_path, 0644)
+            os.rename(temp_path, path)
+        except:
+            os.remove(temp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Returns a SongWriter whose maps are read-only views into a memory-mapped
+        snapshot written by save, so processes loading the same file share its pages
+        '''
+        snapshot = ModelSnapshot(path)
+        song_writer = cls(snapshot.get_all_words())
+        song_writer.words_by_syllable, song_writer.rhyme_groups = snapshot.get_groups()
+        song_writer.rhyme_index = {}
+        for group in song_writer.rhyme_groups:
+            any_word = group[min(group)][0]
+            song_writer.rhyme_index[get_rhyme_suffix(any_word)] = group
+        song_writer.eligible_groups = song_writer.get_eligible_groups()
+        song_writer.first_time = False
+        return song_writer
 
     def get_syllable_frequency(self):
         frequencies = collections.defaultdict(int)
@@ -293,52 +953,258 @@ class SongWriter(object):
                 frequencies[key] += 1
         return frequencies
 
-    def get_valid_rhyme_group(self, rhyme_group, min_syllables, max_syllables):
-        attempts_left = 100
-        while attempts_left > 0:
-            chosen_group = random.choice(rhyme_group)
-            if (chosen_group.has_key(min_syllables) and
-                chosen_group.has_key(max_syllables)):
-                return chosen_group
-            attempts_left -= 1
-        raise NoValidRhymeGroupsFound()
-
-    def get_song(self, rhyming_scheme, min_syllables=1, max_syllables=4):
-        ''' Get a random song based on the words contained in self.trie '''
+    def get_filler_table(self, max_line_syllables, min_syllables, max_syllables):
+        '''
+        Returns a table where entry n lists the syllable counts of the words that
+        can start a run of words adding up to exactly n syllables. An entry is
+        empty when it can't be done, and entry 0 is empty as there's nothing to fill
+        '''
+        word_syllables = [s for s in range(max(min_syllables, 1), max_syllables + 1)
+            if self.words_by_syllable.get(s)]
+        fillers = [[]]
+        for n in range(1, max_line_syllables + 1):
+            fillers.append([s for s in word_syllables if s == n or (s < n and fillers[n - s])])
+        return fillers
+
+    def get_rhyme_word_syllables(self, fillers, line_syllables, choices):
+        ''' Returns the rhyme word syllable counts in choices that leave a line we can fill '''
+        return [r for r in choices if 0 < r <= line_syllables and
+            (r == line_syllables or fillers[line_syllables - r])]
+
+    def get_valid_rhyme_groups(self, scheme, fillers, min_syllables, max_syllables,
+            rng=random):
+        '''
+        Picks a distinct rhyme group for every rhyme in the scheme. Each group has
+        words with min_syllables and max_syllables and can end all of its rhyme's
+        lines. A rhyme whose lines can all end on a min_syllables or max_syllables
+        word can use any group in eligible_groups, the others filter them first
+        '''
+        eligible = self.eligible_groups.get((min_syllables, max_syllables), ())
+        line_lengths = collections.defaultdict(set)
+        for line_syllables, rhyme in scheme:
+            line_lengths[rhyme].add(line_syllables)
+        unrestricted_rhymes = []
+        restricted_rhymes = []
+        for rhyme in sorted(line_lengths):
+            line_choices = [self.get_rhyme_word_syllables(
+                fillers, line_syllables, range(min_syllables, max_syllables + 1))
+                for line_syllables in sorted(line_lengths[rhyme])]
+            if all(min_syllables in c or max_syllables in c for c in line_choices):
+                unrestricted_rhymes.append(rhyme)
+                continue
+            rhyme_group_scans.inc()
+            candidates = [suffix for suffix in eligible if all(
+                any(r in self.rhyme_index[suffix] for r in c) for c in line_choices)]
+            restricted_rhymes.append((len(candidates), rhyme, candidates))
+        scheme_to_words = {}
+        chosen_suffixes = set()
+        # the rhymes with the fewest candidates go first, so they're least likely to run out
+        for num_candidates, rhyme, candidates in sorted(restricted_rhymes):
+            candidates = [suffix for suffix in candidates if suffix not in chosen_suffixes]
+            if not candidates:
+                raise NoValidRhymeGroupsFound()
+            suffix = rng.choice(candidates)
+            chosen_suffixes.add(suffix)
+            scheme_to_words[rhyme] = self.rhyme_index[suffix]
+        num_groups = len(unrestricted_rhymes) + len(chosen_suffixes)
+        if len(eligible) < num_groups:
+            raise NoValidRhymeGroupsFound()
+        sampled_suffixes = [suffix for suffix in rng.sample(eligible, num_groups)
+            if suffix not in chosen_suffixes]
+        for rhyme, suffix in zip(unrestricted_rhymes, sampled_suffixes):
+            scheme_to_words[rhyme] = self.rhyme_index[suffix]
+        return scheme_to_words
+
+    def get_rhymes(self, word, offset=0, limit=None):
+        '''
+        Finds the pool words that rhyme with word through its rhyme suffix.
+        Returns (rhymes, total): rhymes maps syllable counts
+        to lists of words and holds up to limit words from offset, counting through
+        the syllable counts in ascending order. total is every rhyming word
+        '''
+        self.construct_maps()
+        suffix = get_rhyme_suffix(word)
+        rhyme_group = self.rhyme_index.get(suffix, {})
+        buckets = [(syllables, rhyme_group[syllables]) for syllables in sorted(rhyme_group)]
+        total = sum(len(bucket) for syllables, bucket in buckets)
+        if limit is None:
+            limit = total
+        rhymes = {}
+        for syllables, bucket in buckets:
+            if limit <= 0:
+                break
+            if offset >= len(bucket):
+                offset -= len(bucket)
+                continue
+            end = min(len(bucket), offset + limit)
+            rhymes[syllables] = [bucket[i] for i in xrange(offset, end)]
+            limit -= end - offset
+            offset = 0
+        return rhymes, total
+
+    def get_song(self, rhyming_scheme, min_syllables=1, max_syllables=4, rng=random,
+            retries=0, deadline=None):
+        ''' Get a random song made of words from the pool '''
+        return next(self.get_songs(
+            rhyming_scheme, 1, min_syllables, max_syllables, rng, retries, deadline))
+
+    def get_songs(self, rhyming_scheme, num_songs, min_syllables=1, max_syllables=4,
+            rng=random, retries=0, deadline=None):
+        '''
+        Yields num_songs random songs, parsing and checking the rhyming scheme
+        only once for all of them. rng can be a random.Random instance, by
+        default the random module is used. Songs that run out of rhyme groups
+        are started again, up to retries times in all, and DeadlineExceeded is
+        raised if a song is started after the time.time() deadline
+        '''
         if min_syllables > max_syllables:
             min_syllables = max_syllables
         self.construct_maps()
         scheme = self.get_parsed_rhyming_scheme(rhyming_scheme)
-        distinct_schemes = set([line[1] for line in scheme])
-        scheme_to_words = {}
-        # make a copy so we can remove entries to avoid duplicate rhymes, 
-        # but keep the original map around for future songs
-        rhyme_group_copy = list(self.rhyme_groups)
-        for distinct_scheme in distinct_schemes:
-            assert(len(self.rhyme_groups) > 1)
-            rhyme_group = self.get_valid_rhyme_group(
-                rhyme_group_copy, min_syllables, max_syllables)
-            scheme_to_words[distinct_scheme] = rhyme_group
-            rhyme_group_copy.remove(rhyme_group)
+        fillers = self.get_filler_table(
+            max([0] + [line[0] for line in scheme]), min_syllables, max_syllables)
+        # reject lines no rhyme word can complete before doing any other work
+        for line_syllables, rhyme in scheme:
+            if not self.get_rhyme_word_syllables(
+                    fillers, line_syllables, range(min_syllables, max_syllables + 1)):
+                songs_rejected.inc(labels=('impossible_scheme',))
+                raise ImpossibleRhymingScheme()
+        for i in xrange(num_songs):
+            start_time = time.time()
+            while True:
+                if deadline is not None and time.time() > deadline:
+                    songs_rejected.inc(labels=('deadline',))
+                    raise DeadlineExceeded()
+                try:
+                    song = self.compose_song(
+                        scheme, fillers, min_syllables, max_syllables, rng)
+                    break
+                except NoValidRhymeGroupsFound:
+                    if retries <= 0:
+                        songs_rejected.inc(labels=('no_rhyme_groups',))
+                        raise
+                    retries -= 1
+                    song_retries.inc()
+            song_seconds.observe(time.time() - start_time)
+            songs_written.inc()
+            yield song
+
+    def compose_song(self, scheme, fillers, min_syllables, max_syllables, rng=random):
+        '''
+        Writes a song for a parsed scheme. Word lengths are only picked when the
+        rest of the line can still be filled, so every song is built in one pass
+        '''
+        # each rhyme in the scheme gets its own rhyme group, to avoid duplicate rhymes
+        scheme_to_words = self.get_valid_rhyme_groups(
+            scheme, fillers, min_syllables, max_syllables, rng)
         song = []
-        for current_line_scheme in scheme:
-            line = ''
-            current_line_syllables = 0
-            last_word_max_syllables = random.randint(min_syllables, max_syllables) 
-            while current_line_syllables < current_line_scheme[0] - last_word_max_syllables:
-                current_word_syllables = random.randint(min_syllables, max_syllables) 
-                current_word = random.choice(self.words_by_syllable[current_word_syllables])
-                line += current_word + ' '
-                current_line_syllables += current_word_syllables
-            # finish line with word of remaining syllables from chosen rhyme group
-            rhyme_word_syllables = current_line_scheme[0] - current_line_syllables
-            rhyme_word = random.choice(
-                scheme_to_words[current_line_scheme[1]][rhyme_word_syllables])
-            line += rhyme_word
-            song.append(line)
+        for line_syllables, rhyme in scheme:
+            rhyme_group = scheme_to_words[rhyme]
+            group_syllables = [r for r in sorted(rhyme_group)
+                if min_syllables <= r <= max_syllables]
+            rhyme_word_syllables = rng.choice(self.get_rhyme_word_syllables(
+                fillers, line_syllables, group_syllables))
+            line = []
+            remaining_syllables = line_syllables - rhyme_word_syllables
+            while remaining_syllables > 0:
+                current_word_syllables = rng.choice(fillers[remaining_syllables])
+                line.append(rng.choice(self.words_by_syllable[current_word_syllables]))
+                remaining_syllables -= current_word_syllables
+            # finish line with a word from the chosen rhyme group
+            line.append(rng.choice(rhyme_group[rhyme_word_syllables]))
+            song.append(' '.join(line))
         return song
 
 
+def get_trie_size(trie):
+    ''' Approximate number of bytes held by a TrieNode or SortedTrie '''
+    if isinstance(trie, SortedTrie):
+        return sys.getsizeof(trie.words) + sum(sys.getsizeof(w) for w in trie.words)
+    size = 0
+    nodes = [trie]
+    while nodes:
+        node = nodes.pop()
+        size += (sys.getsizeof(node) + sys.getsizeof(node.__dict__) +
+            sys.getsizeof(node.children))
+        nodes.extend(node.children.values())
+    return size
+
+
+class MappedWordList(object):
+    ''' A read-only list of words stored in a ModelSnapshot '''
+
+    def __init__(self, snapshot, ids_offset, length):
+        ''' ids_offset of None means the words are the whole pool, in order '''
+        self.snapshot = snapshot
+        self.ids_offset = ids_offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('word index out of range')
+        if self.ids_offset is not None:
+            index = self.snapshot.read_uint(self.ids_offset + index * SNAPSHOT_UINT.size)
+        return self.snapshot.get_word(index)
+
+    def __iter__(self):
+        for i in xrange(self.length):
+            yield self[i]
+
+
+class ModelSnapshot(object):
+    ''' Reads a snapshot written by SongWriter.save directly from a read-only mmap '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot_file:
+            self.data = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.data) < SNAPSHOT_HEADER.size:
+            raise ValueError('%s is not a song model snapshot' % path)
+        (magic, self.word_count, self.id_count, self.bucket_count,
+            self.group_count) = SNAPSHOT_HEADER.unpack_from(self.data, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('%s is not a song model snapshot' % path)
+        self.offsets_offset = SNAPSHOT_HEADER.size
+        self.buckets_offset = self.offsets_offset + (self.word_count + 1) * SNAPSHOT_UINT.size
+        self.ids_offset = self.buckets_offset + self.bucket_count * SNAPSHOT_BUCKET.size
+        self.text_offset = self.ids_offset + self.id_count * SNAPSHOT_UINT.size
+        # the last word offset is the length of the text, which ends the file
+        if (len(self.data) < self.text_offset or len(self.data) != self.text_offset +
+                self.read_uint(self.offsets_offset + self.word_count * SNAPSHOT_UINT.size)):
+            raise ValueError('%s is truncated or corrupt' % path)
+
+    def read_uint(self, offset):
+        return SNAPSHOT_UINT.unpack_from(self.data, offset)[0]
+
+    def get_word(self, index):
+        offset = self.offsets_offset + index * SNAPSHOT_UINT.size
+        start = self.text_offset + self.read_uint(offset)
+        end = self.text_offset + self.read_uint(offset + SNAPSHOT_UINT.size)
+        return self.data[start:end]
+
+    def get_all_words(self):
+        return MappedWordList(self, None, self.word_count)
+
+    def get_groups(self):
+        ''' Returns (words_by_syllable, rhyme_groups) as maps of syllables to word lists '''
+        words_by_syllable = collections.defaultdict(list)
+        rhyme_groups = [collections.defaultdict(list) for i in range(self.group_count)]
+        for i in range(self.bucket_count):
+            group_index, syllables, start, end = SNAPSHOT_BUCKET.unpack_from(
+                self.data, self.buckets_offset + i * SNAPSHOT_BUCKET.size)
+            if group_index == SNAPSHOT_ALL_WORDS:
+                group = words_by_syllable
+            else:
+                group = rhyme_groups[group_index]
+            group[syllables] = MappedWordList(
+                self, self.ids_offset + start * SNAPSHOT_UINT.size, end - start)
+        return words_by_syllable, rhyme_groups
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--debug', action='store_true', help='Activate debug logging')
@@ -354,31 +1220,64 @@ if __name__ == '__main__':
         help='The rhyming scheme of the song. Defaults to limericks')
     parser.add_argument('-n', '--num-words', type=int, default=50000,
         help='Number of words to add to song pool')
+    parser.add_argument('--rhyme-groups', type=int,
+        help='Generate distinct words until this many rhyme groups have words of 1 to 4 '
+            'syllables, up to --num-words words, instead of a fixed number of words')
+    parser.add_argument('--seed', type=int, help='Seed for generating the song pool')
+    parser.add_argument('--workers', type=int,
+        help='Number of processes reading the source text and generating the song pool. '
+            'Defaults to one per CPU')
     parser.add_argument('--allow-doubles', action='store_true', help='Allow double letters')
-    parser.add_argument('--benchmark', type=int, help='Benchmark x iterations')
+    parser.add_argument('--save-counts', help='Save the source text letter statistics to this path')
+    parser.add_argument('--load-counts',
+        help='Load letter statistics saved with --save-counts instead of reading the source text')
+    parser.add_argument('--save-model', help='Save the song model snapshot to this path')
+    parser.add_argument('--load-model', help='Load a song model snapshot instead of generating words')
+    parser.add_argument('--profile', metavar='PATH',
+        help='Profile the whole run, writing pstats to PATH, a summary to PATH.txt and '
+            'folded stacks for flame graphs to PATH.folded')
     args = parser.parse_args()
 
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
 
-    reader = Reader(open(args.source_text, 'r'))
-    reader.parse_text()
+    if args.profile:
+        profiler = cProfile.Profile()
+        sampler = profiling.StackSampler()
+        def write_profiles():
+            profiler.disable()
+            sampler.stop()
+            profiling.write_profile(profiler, args.profile)
+            sampler.write(args.profile + '.folded')
+        # written however the run ends, including with ctrl-c
+        atexit.register(write_profiles)
+        sampler.start()
+        profiler.enable()
+
+    if args.load_counts:
+        reader = Reader(None)
+        reader.load_counts(args.load_counts)
+    else:
+        reader = Reader(open_corpus(args.source_text))
+        reader.parse_text(args.workers or multiprocessing.cpu_count())
+    if args.save_counts:
+        reader.save_counts(args.save_counts)
     generator = WordGenerator(reader, args.min, args.max, args.allow_doubles)
     user_input = None
 
-    if args.benchmark:
-        iterations = args.benchmark
-        start_time = datetime.datetime.now()
-        for i in range(iterations):
-            generator.generate_word()
-        elapsed = datetime.datetime.now() - start_time
-        print '%s for %s iterations, at %s per iteration' % (
-            elapsed, iterations, elapsed.total_seconds() / iterations)
-        sys.exit(0)
-
     if args.generate_songs:
-        loads_of_words = [generator.generate_word() for i in range(args.num_words)]
-        song_writer = SongWriter(loads_of_words)
+        if args.load_model:
+            song_writer = SongWriter.load(args.load_model)
+        else:
+            if args.rhyme_groups:
+                loads_of_words = generate_covering_pool(
+                    generator, args.rhyme_groups, args.num_words, seed=args.seed)
+            else:
+                loads_of_words = generate_word_pool(
+                    generator, args.num_words, args.seed, args.workers)
+            song_writer = SongWriter(loads_of_words)
+        if args.save_model:
+            song_writer.save(args.save_model)
     
     while user_input != 'q':
         if args.generate_words:
@@ -386,9 +1285,6 @@ if __name__ == '__main__':
             print word, count_syllables(word) 
             user_input = raw_input()
         elif args.generate_songs:
-            try:
-                song = song_writer.get_song(args.rhyming_scheme)
-                print '\n'.join(song)
-            except IndexError:
-                continue
+            song = song_writer.get_song(args.rhyming_scheme)
+            print '\n'.join(song)
             user_input = raw_input()
@@ -1,51 +1,797 @@
+import collections
+import cProfile
 import datetime
 import flask
+import gzip
+import hashlib
+import itertools
+import json
+import logging
+import metrics
+import mimetypes
 import os
+import profiling
+import random
+import re
 import songmaker
+import StringIO
+import threading
+import time
 
 
 app = flask.Flask(__name__)
-song_writer = None
 
+# the word pool is distinct words, generated until this many rhyme groups have words
+# of every syllable count from 1 to 4, or WORD_POOL_SIZE words if that comes first.
+# None generates exactly WORD_POOL_SIZE words
+WORD_POOL_RHYME_GROUPS = 60
 WORD_POOL_SIZE = 50000
+# fixed so a rebuilt model has the same words, and seeded songs stay the same
+WORD_POOL_SEED = 0
+# part of every snapshot name, with the settings above. Bump it when a change
+# to word generation changes the words a seed gives, so old snapshots aren't used
+WORD_POOL_VERSION = 1
+WORD_POOL_WORKERS = None
 MIN_LETTERS = 4
 MAX_LETTERS = 9
+# source texts by the name requests use in ?corpus=
+CORPORA = {
+    'metamorphosis': 'metamorphosis.txt',
+    'eightydays': 'eightydays.txt',
+}
+DEFAULT_CORPUS = 'metamorphosis'
+# corpora loaded by main(), before any worker processes are forked
+PRELOAD_CORPORA = [DEFAULT_CORPUS]
+MODEL_DIR = os.path.dirname(__file__)
+MODEL_MEMORY_BUDGET = 256 * 1024 * 1024
+# rough heap use of a model that couldn't be saved as a snapshot
+IN_MEMORY_BYTES_PER_WORD = 400
+MAX_SONGS_PER_REQUEST = 10000
+# limits on what a request may ask for, anything beyond them is a 400
+MAX_SCHEME_LENGTH = 1000
+MAX_SCHEME_LINES = 100
+MAX_LINE_SYLLABLES = 100
+MAX_WORD_SYLLABLES = 10
+MAX_RHYME_WORD_LENGTH = 64
+# seconds a request may spend writing songs, and how many songs that run out
+# of rhyme groups it may start again
+SONG_DEADLINE = 1.0
+SONGS_DEADLINE = 30.0
+SONG_RETRIES = 3
+# requests that write songs or look up rhymes run at most MAX_IN_FLIGHT at a
+# time. Up to MAX_QUEUED more wait up to QUEUE_TIMEOUT seconds for a turn, the
+# rest are turned away with a 503
+MAX_IN_FLIGHT = 16
+MAX_QUEUED = 32
+QUEUE_TIMEOUT = 0.5
+ADMITTED_ENDPOINTS = ['get_song', 'get_songs', 'get_rhymes']
+SONG_BUFFER_KEYS = 32
+SONG_BUFFER_SIZE = 100
+# bytes of song text all the buffers may hold together, split evenly between the keys
+SONG_BUFFER_BYTES = 4 * 1024 * 1024
+MAX_RHYMES_PER_PAGE = 100
+# how long browsers and caches may keep a seeded song before checking its ETag
+SEEDED_SONG_MAX_AGE = 24 * 60 * 60
+# the website, served from STATIC_DIR: single files and whole directories
+STATIC_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_FILES = ['index.html', 'schemebuilder.html', 'songmaker.js']
+STATIC_TREES = ['bootstrap']
+# versioned asset URLs never change, so they can be cached for a year
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+# smaller files aren't worth compressing
+GZIP_MIN_SIZE = 256
+# profile one in every PROFILE_EVERY requests, None profiles none. The latest
+# PROFILE_MAX_FILES profiles are kept in PROFILE_DIR, to read with pstats
+PROFILE_EVERY = None
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+PROFILE_MAX_FILES = 100
+# the limerick, sonnet and Burns stanza presets in songmaker.js, with its default syllables
+PRESET_SCHEMES = [
+    ('8a,8a,5b,5b,8a', 1, 4),
+    ('10a,10b,10b,10a,10a,10b,10b,10a,10c,10d,10e,10c,10d,10e', 1, 4),
+    ('9a,9a,9a,5b,9a,5b', 1, 4),
+]
 
+requests_total = metrics.Counter(
+    'songservice_requests_total', 'HTTP requests by route and status', ['route', 'status'])
+request_seconds = metrics.Histogram(
+    'songservice_request_seconds', 'Time taken to answer HTTP requests, by route', ['route'])
+song_buffer_requests = metrics.Counter('songservice_song_buffer_requests_total',
+    'Songs asked of the song buffer, by whether one was ready', ['result'])
+model_load_seconds = metrics.Gauge('songservice_model_load_seconds',
+    'Time the last load or build of each model took', ['corpus'])
+startup_seconds = metrics.Gauge('songservice_startup_seconds', 'Time main() took')
+requests_shed = metrics.Counter('songservice_requests_shed_total',
+    'Requests turned away because too many were already running or waiting')
 
-def main():
-    global song_writer
-    text_path = os.path.join(os.path.dirname(__file__), 'metamorphosis.txt')
-    reader = songmaker.Reader(open(text_path, 'r'))
+
+class ModelRegistry(object):
+    '''
+    Holds a SongWriter for each (corpus, min letters, max letters), loading or
+    building it the first time it's asked for. Once the models add up to more
+    than memory_budget bytes the least recently used ones are dropped
+    '''
+    def __init__(self, load_model, memory_budget):
+        self.load_model = load_model
+        self.memory_budget = memory_budget
+        self.models = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+    def add(self, key, song_writer):
+        # build the maps before the model is shared, requests only read them
+        song_writer.construct_maps()
+        with self.lock:
+            self.models.pop(key, None)
+            self.models[key] = (song_writer, get_model_size(song_writer))
+            total_size = sum(size for model, size in self.models.values())
+            for other_key in list(self.models):
+                if total_size <= self.memory_budget:
+                    break
+                if other_key != key:
+                    total_size -= self.models.pop(other_key)[1]
+
+    def get(self, key):
+        ''' Returns the model for key, loading it if needed. Only one thread loads a key '''
+        with self.lock:
+            model = self.models.pop(key, None)
+            if model is not None:
+                # re-insert so the most recently used models are last
+                self.models[key] = model
+                return model[0]
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                if key in self.models:
+                    return self.models[key][0]
+            song_writer = self.load_model(*key)
+            self.add(key, song_writer)
+            with self.lock:
+                self.key_locks.pop(key, None)
+            return song_writer
+
+    def replace(self, key):
+        '''
+        Loads key's model again, for instance after its snapshot was rebuilt, and
+        swaps it in once it's complete. Requests use the old model until then
+        '''
+        song_writer = self.load_model(*key)
+        self.add(key, song_writer)
+        return song_writer
+
+
+class AdmissionQueue(object):
+    '''
+    Lets at most max_in_flight requests run at once, with up to max_waiting more
+    waiting up to wait_timeout seconds for one of them to finish
+    '''
+    def __init__(self, max_in_flight, max_waiting, wait_timeout):
+        self.max_in_flight = max_in_flight
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+    def admit(self):
+        ''' Returns True once the request may run, or False if it should be turned away '''
+        with self.condition:
+            if self.in_flight < self.max_in_flight:
+                self.in_flight += 1
+                return True
+            if self.waiting >= self.max_waiting:
+                return False
+            self.waiting += 1
+            try:
+                end_time = time.time() + self.wait_timeout
+                while self.in_flight >= self.max_in_flight:
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                self.in_flight += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+
+class StaticAsset(object):
+    ''' A file's contents, its gzipped contents if they're smaller, and its ETag '''
+    def __init__(self, data, mimetype):
+        self.data = data
+        self.mimetype = mimetype
+        self.etag = hashlib.md5(data).hexdigest()
+        # pages link to assets with ?v=version, so a new version is a new URL
+        self.version = self.etag[:12]
+        self.gzipped = None
+        if len(data) >= GZIP_MIN_SIZE:
+            gzipped = gzip_data(data)
+            if len(gzipped) < len(data):
+                self.gzipped = gzipped
+
+
+class StaticAssets(object):
+    '''
+    Holds every static file of the website in memory, compressed once at
+    startup. HTML pages have their links to other assets rewritten to
+    versioned URLs, which browsers can cache without ever checking them again
+    '''
+    link_pattern = re.compile(r'''((?:href|src)=["'])([^"'?#]+)(["'])''')
+
+    def __init__(self, root, files, trees):
+        self.root = root
+        self.files = files
+        self.trees = trees
+        self.assets = {}
+
+    def get_paths(self):
+        ''' The URL paths of every file, relative to root '''
+        paths = list(self.files)
+        for tree in self.trees:
+            for directory, subdirectories, file_names in os.walk(os.path.join(self.root, tree)):
+                for file_name in file_names:
+                    path = os.path.relpath(os.path.join(directory, file_name), self.root)
+                    paths.append(path.replace(os.sep, '/'))
+        return sorted(paths)
+
+    def load(self):
+        assets = {}
+        pages = []
+        for path in self.get_paths():
+            with open(os.path.join(self.root, path), 'rb') as static_file:
+                data = static_file.read()
+            mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            if mimetype == 'text/html':
+                pages.append((path, data))
+            else:
+                assets[path] = StaticAsset(data, mimetype)
+        # pages last, they need the versions of the assets they link to
+        for path, data in pages:
+            assets[path] = StaticAsset(self.add_versions(data, assets), 'text/html')
+        self.assets = assets
+
+    def add_versions(self, page, assets):
+        def add_version(match):
+            prefix, url, suffix = match.groups()
+            if url not in assets:
+                return match.group(0)
+            return '%s%s?v=%s%s' % (prefix, url, assets[url].version, suffix)
+        return self.link_pattern.sub(add_version, page)
+
+
+def gzip_data(data):
+    ''' Compresses data with no timestamp, so the same data always gives the same bytes '''
+    buf = StringIO.StringIO()
+    with gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=buf, mtime=0) as gzip_file:
+        gzip_file.write(data)
+    return buf.getvalue()
+
+
+thread_state = threading.local()
+
+
+def get_rng():
+    ''' This thread's random number generator, so threads never share random state '''
+    rng = getattr(thread_state, 'rng', None)
+    if rng is None:
+        rng = thread_state.rng = random.Random()
+    return rng
+
+
+class SongBuffer(object):
+    '''
+    Keeps a buffer of ready-made songs for each recently requested model,
+    scheme, minSyllables and maxSyllables, topped up by a background thread.
+    A key gets a buffer on its second request, and the least recently used
+    buffer is dropped when there are more than max_keys. Each buffer holds
+    at most songs_per_key songs and max_bytes / max_keys bytes of song text,
+    so long schemes get fewer songs and never more than max_bytes in all
+    '''
+    def __init__(self, write_songs, max_keys, songs_per_key, max_bytes):
+        self.write_songs = write_songs
+        self.max_keys = max_keys
+        self.songs_per_key = songs_per_key
+        self.bytes_per_key = max_bytes / max_keys
+        self.buffers = collections.OrderedDict()
+        self.buffered_bytes = {}
+        # the size of the songs of each key, learnt from the first one written
+        self.song_sizes = {}
+        self.seen_keys = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.refill_needed = threading.Event()
+
+    def add_key(self, key):
+        ''' Gives key a buffer, evicting the least recently used. Call with the lock held '''
+        self.buffers[key] = collections.deque()
+        self.buffered_bytes[key] = 0
+        while len(self.buffers) > self.max_keys:
+            self.remove_key(next(iter(self.buffers)))
+        self.refill_needed.set()
+
+    def remove_key(self, key):
+        ''' Call with the lock held '''
+        self.buffers.pop(key, None)
+        self.buffered_bytes.pop(key, None)
+        self.song_sizes.pop(key, None)
+
+    def preload(self, keys):
+        with self.lock:
+            for key in keys:
+                self.add_key(key)
+
+    def get_song(self, key):
+        ''' Returns a buffered song for key, or None if there isn't one ready '''
+        with self.lock:
+            songs = self.buffers.pop(key, None)
+            if songs is None:
+                if self.seen_keys.pop(key, None) is None:
+                    self.seen_keys[key] = True
+                    while len(self.seen_keys) > self.max_keys:
+                        self.seen_keys.popitem(last=False)
+                else:
+                    self.add_key(key)
+                return None
+            # re-insert so the most recently used buffers are last
+            self.buffers[key] = songs
+            self.refill_needed.set()
+            if songs:
+                song = songs.popleft()
+                self.buffered_bytes[key] -= get_song_size(song)
+                return song
+            return None
+
+    def get_shortfall(self, key):
+        ''' How many songs key's buffer has room for. Call with the lock held '''
+        shortfall = self.songs_per_key - len(self.buffers[key])
+        song_size = self.song_sizes.get(key)
+        if song_size is None:
+            # write one song first to find out how big they are
+            return min(shortfall, 1)
+        room = self.bytes_per_key - self.buffered_bytes[key]
+        return min(shortfall, room / max(song_size, 1))
+
+    def refill(self):
+        ''' Tops up every buffer, writing the songs without holding the lock '''
+        with self.lock:
+            keys = list(self.buffers)
+        for key in keys:
+            while True:
+                with self.lock:
+                    if key not in self.buffers:
+                        break
+                    shortfall = self.get_shortfall(key)
+                    probing = key not in self.song_sizes
+                if shortfall <= 0:
+                    break
+                try:
+                    songs = self.write_songs(key, shortfall)
+                except songmaker.NoValidRhymeGroupsFound:
+                    # leave impossible schemes to the normal path
+                    with self.lock:
+                        self.remove_key(key)
+                    break
+                with self.lock:
+                    if key not in self.buffers:
+                        break
+                    for song in songs:
+                        song_size = get_song_size(song)
+                        self.song_sizes[key] = max(self.song_sizes.get(key, 0), song_size)
+                        if self.buffered_bytes[key] + song_size > self.bytes_per_key:
+                            break
+                        self.buffers[key].append(song)
+                        self.buffered_bytes[key] += song_size
+                if not probing:
+                    break
+
+    def run(self):
+        while True:
+            self.refill_needed.wait()
+            self.refill_needed.clear()
+            try:
+                self.refill()
+            except Exception:
+                logging.exception('could not refill song buffers')
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='song-buffer')
+        thread.daemon = True
+        thread.start()
+
+
+def get_song_size(song):
+    return sum(len(line) for line in song)
+
+
+def write_songs(song_key, count):
+    model_key, scheme, min_syllables, max_syllables = song_key
+    song_writer = models.get(model_key)
+    return list(song_writer.get_songs(scheme, count, min_syllables, max_syllables, get_rng()))
+
+
+def get_song_key(model_key, scheme, min_syllables, max_syllables):
+    ''' Buffer key for a request, ignoring whitespace in the scheme '''
+    return (model_key, ''.join(scheme.split()), min_syllables, max_syllables)
+
+
+def get_model_size(song_writer):
+    ''' Bytes used by a model: its snapshot if it's memory-mapped, otherwise an estimate '''
+    if isinstance(song_writer.all_words, songmaker.MappedWordList):
+        return len(song_writer.all_words.snapshot.data)
+    return len(song_writer.all_words) * IN_MEMORY_BYTES_PER_WORD
+
+
+def get_snapshot_path(corpus, min_letters, max_letters):
+    '''
+    The snapshot file of a model, named after everything that decides its words
+    and the snapshot format, so changing any of them builds a new model
+    '''
+    name = '%s-%s-%s-n%s-g%s-s%s-p%s-v%s.model' % (corpus, min_letters, max_letters,
+        WORD_POOL_SIZE, WORD_POOL_RHYME_GROUPS, WORD_POOL_SEED, WORD_POOL_VERSION,
+        songmaker.SNAPSHOT_VERSION)
+    return os.path.join(MODEL_DIR, name)
+
+
+def load_model(corpus, min_letters, max_letters):
+    '''
+    Loads the snapshot of a model, or builds the model from its corpus and
+    saves it. Snapshots are mmapped, so every worker process shares the same pages
+    '''
+    start_time = time.time()
+    snapshot_path = get_snapshot_path(corpus, min_letters, max_letters)
+    if os.path.exists(snapshot_path):
+        try:
+            song_writer = songmaker.SongWriter.load(snapshot_path)
+        except ValueError:
+            logging.exception('rebuilding unreadable model snapshot %s' % snapshot_path)
+        else:
+            model_load_seconds.set(time.time() - start_time, labels=(corpus,))
+            return song_writer
+    text_path = os.path.join(os.path.dirname(__file__), CORPORA[corpus])
+    reader = songmaker.Reader(songmaker.open_corpus(text_path))
     reader.parse_text()
     generator = songmaker.WordGenerator(
         reader,
-        min_letters=MIN_LETTERS, 
-        max_letters=MAX_LETTERS, 
+        min_letters=min_letters, 
+        max_letters=max_letters, 
         allow_doubles=False)
-    loads_of_words = [generator.generate_word() for i in range(WORD_POOL_SIZE)]
+    if WORD_POOL_RHYME_GROUPS:
+        loads_of_words = songmaker.generate_covering_pool(
+            generator, WORD_POOL_RHYME_GROUPS, WORD_POOL_SIZE, seed=WORD_POOL_SEED)
+    else:
+        loads_of_words = songmaker.generate_word_pool(
+            generator, WORD_POOL_SIZE, WORD_POOL_SEED, WORD_POOL_WORKERS)
     song_writer = songmaker.SongWriter(loads_of_words)
+    # build the maps now rather than on a request, the song buffer shares them
+    song_writer.construct_maps()
+    try:
+        song_writer.save(snapshot_path)
+    except EnvironmentError:
+        logging.exception('could not save model snapshot to %s' % snapshot_path)
+    else:
+        song_writer = songmaker.SongWriter.load(snapshot_path)
+    model_load_seconds.set(time.time() - start_time, labels=(corpus,))
+    return song_writer
+
+
+models = ModelRegistry(load_model, MODEL_MEMORY_BUDGET)
+song_buffer = SongBuffer(write_songs, SONG_BUFFER_KEYS, SONG_BUFFER_SIZE, SONG_BUFFER_BYTES)
+static_assets = StaticAssets(STATIC_DIR, STATIC_FILES, STATIC_TREES)
+request_count = itertools.count()
+admission_queue = AdmissionQueue(MAX_IN_FLIGHT, MAX_QUEUED, QUEUE_TIMEOUT)
+# set by warm_up, /ready and /healthz report them
+ready = threading.Event()
+warm_up_failed = threading.Event()
+
+
+def warm_up(start_time):
+    '''
+    Loads or builds the preloaded models and starts filling the song buffers,
+    then marks the service ready
+    '''
+    try:
+        for corpus in PRELOAD_CORPORA:
+            models.get((corpus, MIN_LETTERS, MAX_LETTERS))
+    except Exception:
+        logging.exception('could not warm up the song service')
+        warm_up_failed.set()
+        return
+    song_buffer.preload([get_song_key((DEFAULT_CORPUS, MIN_LETTERS, MAX_LETTERS), *preset)
+        for preset in PRESET_SCHEMES])
+    song_buffer.start()
+    startup_seconds.set(time.time() - start_time)
+    ready.set()
+    logging.info('song service ready after %.1fs' % (time.time() - start_time))
+
+def main(background=True):
+    '''
+    Loads the static files and starts warming up in the background, /ready says
+    when it's done. Servers that fork workers after calling main() can pass
+    background=False to warm up before it returns, as threads don't survive a fork
+    '''
+    start_time = time.time()
+    static_assets.load()
+    if not background:
+        warm_up(start_time)
+        return
+    thread = threading.Thread(target=warm_up, args=(start_time,), name='warm-up')
+    thread.daemon = True
+    thread.start()
+
+@app.before_request
+def start_timer():
+    flask.g.start_time = time.time()
+
+@app.after_request
+def remember_status(resp):
+    flask.g.status = resp.status_code
+    return resp
+
+@app.teardown_request
+def record_request(exception):
+    # after_request hooks are skipped on unhandled exceptions, teardown always
+    # runs, and for streamed responses only once the stream has finished
+    start_time = getattr(flask.g, 'start_time', None)
+    if start_time is None:
+        return
+    flask.g.start_time = None
+    status = 500 if exception is not None else getattr(flask.g, 'status', 500)
+    route = flask.request.url_rule.rule if flask.request.url_rule else 'unmatched'
+    requests_total.inc(labels=(route, status))
+    request_seconds.observe(time.time() - start_time, labels=(route,))
+
+@app.before_request
+def admit_request():
+    if flask.request.endpoint not in ADMITTED_ENDPOINTS:
+        return None
+    if not admission_queue.admit():
+        requests_shed.inc()
+        return make_busy_response()
+    flask.g.admitted = True
+
+@app.teardown_request
+def release_request(exception):
+    # streamed responses keep their request context until the stream ends
+    if getattr(flask.g, 'admitted', False):
+        flask.g.admitted = False
+        admission_queue.release()
+
+def make_busy_response():
+    resp = flask.Response('too busy, try again shortly\n', status=503, mimetype='text/plain')
+    resp.headers['Retry-After'] = '1'
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    return resp
+
+@app.before_request
+def start_profile():
+    if PROFILE_EVERY and next(request_count) % PROFILE_EVERY == 0:
+        flask.g.profiler = cProfile.Profile()
+        flask.g.profiler.enable()
+
+@app.teardown_request
+def stop_profile(exception):
+    # runs even when the view raised, and after a streamed response's last byte
+    profiler = getattr(flask.g, 'profiler', None)
+    if profiler is not None:
+        flask.g.profiler = None
+        profiler.disable()
+        name = flask.request.endpoint or 'unmatched'
+        profiling.dump_request_profile(profiler, PROFILE_DIR, name, PROFILE_MAX_FILES)
+
+def get_model_key():
+    ''' The model a request asks for with ?corpus=, 404ing unknown corpora '''
+    corpus = flask.request.args.get('corpus', DEFAULT_CORPUS)
+    if corpus not in CORPORA:
+        flask.abort(404)
+    return (corpus, MIN_LETTERS, MAX_LETTERS)
+
+def get_seed():
+    ''' The ?seed= of a request as an int, or None. 400s seeds that aren't integers '''
+    seed = flask.request.args.get('seed')
+    if seed is None:
+        return None
+    try:
+        return int(seed)
+    except ValueError:
+        flask.abort(400)
+
+def get_song_parameters():
+    '''
+    The scheme, minSyllables and maxSyllables of a request, 400ing any that
+    aren't integers, are out of range or make a scheme too big to write
+    '''
+    scheme = flask.request.args.get('scheme', '')
+    if len(scheme) > MAX_SCHEME_LENGTH:
+        flask.abort(400)
+    lines = songmaker.parse_rhyming_scheme(scheme)
+    if not 0 < len(lines) <= MAX_SCHEME_LINES:
+        flask.abort(400)
+    if not all(0 < syllables <= MAX_LINE_SYLLABLES for syllables, rhyme in lines):
+        flask.abort(400)
+    try:
+        min_syllables = int(flask.request.args.get('minSyllables', 1))
+        max_syllables = int(flask.request.args.get('maxSyllables', 4))
+    except ValueError:
+        flask.abort(400)
+    # minSyllables above maxSyllables is allowed, the song writer lowers it
+    for syllables in (min_syllables, max_syllables):
+        if not 0 < syllables <= MAX_WORD_SYLLABLES:
+            flask.abort(400)
+    return scheme, min_syllables, max_syllables
+
+def make_song_response(songlines, seeded):
+    '''
+    A song response. Seeded songs never change, so they get a strong ETag and
+    can be cached, the others mustn't be
+    '''
+    resp = flask.make_response(flask.jsonify({'songlines': songlines}))
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    if not seeded:
+        resp.headers['Cache-Control'] = 'no-store'
+        return resp
+    resp.add_etag()
+    resp.headers['Cache-Control'] = 'public, max-age=%s' % SEEDED_SONG_MAX_AGE
+    return resp.make_conditional(flask.request)
 
 @app.route("/")
 def get_song():
-    scheme = flask.request.args.get('scheme')
-    min_syllables = int(flask.request.args.get('minSyllables', 1))
-    max_syllables = int(flask.request.args.get('maxSyllables', 4))
-    while True:
+    '''
+    Returns a random song. The same ?seed= with the same corpus, scheme,
+    minSyllables and maxSyllables always returns the same song. Without a seed,
+    ?redirect=seeded redirects to the URL of a newly seeded song
+    '''
+    model_key = get_model_key()
+    scheme, min_syllables, max_syllables = get_song_parameters()
+    seed = get_seed()
+    if seed is None and flask.request.args.get('redirect') == 'seeded':
+        args = flask.request.args.to_dict()
+        del args['redirect']
+        args['seed'] = get_rng().getrandbits(32)
+        resp = flask.redirect(flask.url_for('get_song', **args))
+        resp.headers['Cache-Control'] = 'no-store'
+        return resp
+    try:
+        song = None
+        if seed is None:
+            song = song_buffer.get_song(
+                get_song_key(model_key, scheme, min_syllables, max_syllables))
+            song_buffer_requests.inc(labels=('miss' if song is None else 'hit',))
+        if song is None:
+            song_writer = models.get(model_key)
+            rng = get_rng() if seed is None else random.Random(seed)
+            song = song_writer.get_song(scheme, min_syllables, max_syllables, rng,
+                SONG_RETRIES, time.time() + SONG_DEADLINE)
+        return make_song_response(song, seed is not None)
+    except songmaker.DeadlineExceeded:
+        return make_busy_response()
+    except songmaker.NoValidRhymeGroupsFound:
+        return make_song_response(
+            ['could not create a song with those parameters'], seed is not None)
+
+@app.route("/songs")
+def get_songs():
+    '''
+    Streams count songs as newline-delimited JSON, one {"songlines": [...]}
+    object per line, sending each song as soon as it's written
+    '''
+    model_key = get_model_key()
+    scheme, min_syllables, max_syllables = get_song_parameters()
+    try:
+        count = min(int(flask.request.args.get('count', 1)), MAX_SONGS_PER_REQUEST)
+    except ValueError:
+        flask.abort(400)
+    if count < 1:
+        flask.abort(400)
+    song_writer = models.get(model_key)
+    deadline = time.time() + SONGS_DEADLINE
+    def generate_lines():
+        # the songs are written while the response streams, with an rng of their own
+        rng = random.Random()
         try:
-            song = song_writer.get_song(scheme, min_syllables, max_syllables)
-            resp = flask.make_response(flask.jsonify({'songlines': song}))
-            resp.headers['Access-Control-Allow-Origin'] = '*'
-            return resp
-        except IndexError:
-            continue
+            for song in song_writer.get_songs(scheme, count, min_syllables, max_syllables,
+                    rng, SONG_RETRIES, deadline):
+                yield json.dumps({'songlines': song}) + '\n'
+        except songmaker.DeadlineExceeded:
+            yield json.dumps({'songlines': ['ran out of time writing songs']}) + '\n'
         except songmaker.NoValidRhymeGroupsFound:
-            resp = flask.make_response(flask.jsonify(
-                {'songlines': ['could not create a song with those parameters']}))
-            resp.headers['Access-Control-Allow-Origin'] = '*'
-            return resp
+            yield json.dumps(
+                {'songlines': ['could not create a song with those parameters']}) + '\n'
+    # keep the request context, and its place in the admission queue, until the
+    # last song is sent
+    resp = flask.Response(flask.stream_with_context(generate_lines()),
+        mimetype='application/x-ndjson')
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    return resp
+
+@app.route("/rhymes")
+def get_rhymes():
+    '''
+    Returns a page of the pool words that rhyme with ?word=, by syllable count.
+    ?offset= and ?limit= pick the page, next is the URL of the following one
+    '''
+    model_key = get_model_key()
+    word = flask.request.args.get('word', '')
+    if len(word) > MAX_RHYME_WORD_LENGTH or not re.match(r'[a-zA-Z]+\Z', word):
+        flask.abort(400)
+    word = str(word.lower())
+    try:
+        offset = max(int(flask.request.args.get('offset', 0)), 0)
+        limit = min(int(flask.request.args.get('limit', MAX_RHYMES_PER_PAGE)),
+            MAX_RHYMES_PER_PAGE)
+    except ValueError:
+        flask.abort(400)
+    # an empty page would have itself as the next one
+    if limit < 1:
+        flask.abort(400)
+    # only load the model once the request is known to be good
+    song_writer = models.get(model_key)
+    rhymes, total = song_writer.get_rhymes(word, offset, limit)
+    next_url = None
+    next_offset = offset + sum(len(words) for words in rhymes.values())
+    if next_offset < total:
+        args = flask.request.args.to_dict()
+        args['offset'] = next_offset
+        next_url = flask.url_for('get_rhymes', **args)
+    resp = flask.make_response(flask.jsonify({
+        'word': word,
+        'suffix': songmaker.get_rhyme_suffix(word),
+        'rhymes': rhymes,
+        'total': total,
+        'next': next_url,
+    }))
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    return resp
+
+@app.route("/healthz")
+def get_health():
+    ''' 200 while the process can serve, 500 once warming up has failed '''
+    if warm_up_failed.is_set():
+        return flask.Response('warm-up failed\n', status=500, mimetype='text/plain')
+    return flask.Response('ok\n', mimetype='text/plain')
+
+@app.route("/ready")
+def get_ready():
+    ''' 200 once the preloaded models are built, 503 until then '''
+    if not ready.is_set():
+        resp = flask.Response('warming up\n', status=503, mimetype='text/plain')
+        resp.headers['Retry-After'] = '1'
+        return resp
+    return flask.Response('ready\n', mimetype='text/plain')
+
+@app.route("/<path:path>")
+def get_static_asset(path):
+    '''
+    Serves a file of the website, gzipped if the client accepts it. Versioned
+    URLs are cached for good, anything else is checked against its ETag
+    '''
+    asset = static_assets.assets.get(path)
+    if asset is None:
+        flask.abort(404)
+    use_gzip = asset.gzipped is not None and flask.request.accept_encodings['gzip'] > 0
+    resp = flask.Response(asset.gzipped if use_gzip else asset.data, mimetype=asset.mimetype)
+    resp.headers['Vary'] = 'Accept-Encoding'
+    if use_gzip:
+        resp.headers['Content-Encoding'] = 'gzip'
+        resp.set_etag(asset.etag + '-gzip')
+    else:
+        resp.set_etag(asset.etag)
+    if flask.request.args.get('v') == asset.version:
+        resp.headers['Cache-Control'] = 'public, max-age=%s, immutable' % STATIC_MAX_AGE
+    else:
+        resp.headers['Cache-Control'] = 'no-cache'
+    return resp.make_conditional(flask.request)
+
+@app.route("/metrics")
+def get_metrics():
+    ''' Every songmaker and songservice metric, in the Prometheus text format '''
+    return flask.Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     main()
-    print 'ready'
-    app.run(host='0.0.0.0', debug=True, use_reloader=False)
+    app.run(host='0.0.0.0', debug=True, use_reloader=False, threaded=True)
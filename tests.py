@@ -1,6 +1,22 @@
+import benchmark
+import cProfile
+import gzip
+import json
+import metrics
+import os
+import profiling
+import pstats
+import random
+import shutil
 import songmaker
+import songservice
 import StringIO
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import urlparse
 
 
 class TestTrie(unittest.TestCase):
@@ -57,6 +73,52 @@ class TestTrie(unittest.TestCase):
         self.assertItemsEqual(suffixes, ['an', 'ish'])
 
 
+class TestSortedTrie(unittest.TestCase):
+
+    def test_word_with_prefix(self):
+        root = songmaker.SortedTrie()
+        words = [
+            'predeterminism', 'predetermined', 'prevent', 'prevented', 'previous', 'arse']
+        for word in words:
+            root.add_letters(word)
+        self.assertItemsEqual(
+            root.words_with_prefix('prev'), ['prevent', 'prevented', 'previous'])
+        self.assertItemsEqual(
+            root.words_with_prefix('prevent'), ['prevent', 'prevented'])
+        self.assertItemsEqual(root.words_with_prefix('prez'), [])
+        self.assertItemsEqual(root.words_with_prefix(''), words)
+
+    def test_duplicates_are_collapsed(self):
+        root = songmaker.SortedTrie()
+        for word in ['necro', 'necro', 'necrodeath']:
+            root.add_letters(word)
+        self.assertItemsEqual(root.get_all_words(), ['necro', 'necrodeath'])
+
+    def test_get_all_prefixes_reversed(self):
+        root = songmaker.SortedTrie()
+        for word in ['batman', 'superman', 'fish', 'dish']:
+            root.add_letters(word[::-1])
+        suffixes = root.get_all_prefixes(num_syllables=1, reverse=True)
+        self.assertItemsEqual([s[::-1] for s in suffixes], ['an', 'ish'])
+
+    def test_matches_trie_node(self):
+        words = ['banana', 'bandana', 'baseball', 'batman', 'smoke', 'crack',
+            'phone', 'tone', 'fantastish', 'fish', 'dish', 'glombar', 'car']
+        trie_node = songmaker.TrieNode()
+        sorted_trie = songmaker.SortedTrie()
+        for word in words:
+            trie_node.add_letters(word[::-1])
+            sorted_trie.add_letters(word[::-1])
+        for syllables in range(4):
+            self.assertEqual(
+                sorted_trie.get_all_prefixes(syllables, reverse=True),
+                trie_node.get_all_prefixes(syllables, reverse=True))
+        for prefix in trie_node.get_all_prefixes(1, reverse=True):
+            self.assertItemsEqual(
+                sorted_trie.words_with_prefix(prefix, reverse=True),
+                trie_node.words_with_prefix(prefix, reverse=True))
+
+
 class TestSyllables(unittest.TestCase):
     ''' Tests for the syllable counting function '''
     def test_various_words(self):
@@ -74,6 +136,17 @@ class TestSyllables(unittest.TestCase):
             self.assertEqual(calculated_syllables, syllables,
                 '%s should have had %s syllables, but had %s' % (
                     word, syllables, calculated_syllables)) 
+
+    def test_batch(self):
+        words = ['motherfucker', 'peepee', 'flange', 'peepee', 'zwfqrns']
+        self.assertEqual(songmaker.count_syllables_batch(words), [4, 2, 1, 2, 0])
+
+    def test_cache_is_bounded(self):
+        cache = songmaker.SyllableCache(2)
+        for word in ['flange', 'peepee', 'empyrean', 'biography', 'flange']:
+            self.assertEqual(cache.get(word), songmaker.scan_syllables(word))
+        self.assertTrue(len(cache.current) + len(cache.previous) <= 4)
+        self.assertTrue('flange' in cache.current)
                 
 
 class TestLetter(unittest.TestCase):
@@ -116,6 +189,48 @@ class TestReader(unittest.TestCase):
         self.assertEqual(reader.letters['t'].followers['u'], 1)
         self.assertEqual(reader.letters['u'].followers['f'], 0)
 
+    def test_words_split_across_chunks(self):
+        text = StringIO.StringIO('two words\nwhat\nwords')
+        chunks = list(songmaker.read_chunks(text, chunk_size=4))
+        self.assertEqual(''.join(chunks), 'two words\nwhat\nwords')
+        for chunk in chunks[:-1]:
+            self.assertFalse(chunk[-1].isalpha())
+
+    def test_count_letters(self):
+        followers, positions = songmaker.count_letters('Two words, TWO')
+        self.assertEqual(followers['tw'], 2)
+        self.assertEqual(followers['wo'], 3)
+        self.assertEqual(positions[('o', 2)], 2)
+        self.assertEqual(positions[('o', 1)], 1)
+
+    def test_parse_text_in_process_pool(self):
+        text = 'face bard cash mang fish pish czar\n' * 20
+        self.assertTrue(len(list(songmaker.read_chunks(StringIO.StringIO(text), 64))) > 4)
+        reader = songmaker.Reader(StringIO.StringIO(text))
+        reader.parse_text()
+        pool_reader = songmaker.Reader(StringIO.StringIO(text))
+        # small chunks, so the workers' partial counts have to be merged
+        pool_reader.parse_text(num_workers=2, chunk_size=64)
+        for letter in songmaker.LOWER_CASE_LETTERS:
+            self.assertEqual(pool_reader.letters[letter].followers,
+                reader.letters[letter].followers)
+            self.assertEqual(pool_reader.letters[letter].positions,
+                reader.letters[letter].positions)
+
+    def test_save_and_load_counts(self):
+        reader = songmaker.Reader(StringIO.StringIO('face bard cash mang fish pish czar'))
+        reader.parse_text()
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'counts.json')
+            reader.save_counts(path)
+            loaded_reader = songmaker.Reader(None)
+            loaded_reader.load_counts(path)
+        finally:
+            shutil.rmtree(temp_dir)
+        self.assertEqual(loaded_reader.letters_at_position(1, 26), reader.letters_at_position(1, 26))
+        self.assertEqual(loaded_reader.following_letters('a', 26), reader.following_letters('a', 26))
+
     def test_letters_at_position(self):
         text = StringIO.StringIO('face bard cash mang fish pish czar')
         reader = songmaker.Reader(text)
@@ -138,6 +253,131 @@ class TestReader(unittest.TestCase):
         self.assertEqual(letters, ['d', 'c', 'q'])
 
 
+class TestWordGenerator(unittest.TestCase):
+
+    def setUp(self):
+        text = StringIO.StringIO('the quick brown fox jumps over the lazy dog ' * 10)
+        self.reader = songmaker.Reader(text)
+        self.reader.parse_text()
+
+    def test_generate_words_lengths(self):
+        generator = songmaker.WordGenerator(self.reader, 3, 6, allow_doubles=False)
+        for word in generator.generate_words(200):
+            self.assertTrue(3 <= len(word) <= 6)
+
+    def test_generate_words_never_break_reject_rules(self):
+        text = StringIO.StringIO('mrs gnat strands tl dr nl hrm ' * 5 +
+            'the quick brown fox jumps over the lazy dog ' * 10)
+        reader = songmaker.Reader(text)
+        reader.parse_text()
+        generator = songmaker.WordGenerator(reader, 2, 8, allow_doubles=True)
+        for word in generator.generate_words(500, random.Random(3)):
+            self.assertIsNone(generator.reject_patterns.search(word), word)
+
+    def generate_word_by_letter(self, generator, rng):
+        '''
+        The original generator, which looked up the letter statistics for every
+        letter and drew again whenever a letter broke a reject rule. Returns the
+        word and whether the compiled tables offered exactly the same letters at
+        every step, in which case the same random numbers pick the same letters
+        '''
+        reader = generator.reader
+        word_length = rng.randint(generator.min_letters, generator.max_letters)
+        first_letters = reader.letters_at_position(0, generator.start_letters)
+        table_letters = [l for l, run in generator.first_letters_by_length[word_length]]
+        self.assertTrue(set(table_letters) <= set(first_letters))
+        same_choices = table_letters == first_letters
+        word = rng.choice(first_letters)
+        run = 1 if word in songmaker.CONSONANTS else 0
+        while len(word) < word_length:
+            frequent_followers = reader.following_letters(word[-1], generator.follower_count)
+            if not generator.allow_doubles and word[-1] in frequent_followers:
+                frequent_followers.remove(word[-1])
+            most_likely_at_position = reader.specific_letters_at_position(
+                position=len(word), letters=frequent_followers)[:generator.position_limit]
+            table_letters = [l for l, next_run in generator.transitions.get(
+                (word[-1], run, len(word), word_length), [])]
+            self.assertTrue(set(table_letters) <= set(most_likely_at_position))
+            same_choices = same_choices and table_letters == most_likely_at_position
+            next_letter = rng.choice(most_likely_at_position)
+            if generator.reject_patterns.search(word + next_letter):
+                same_choices = False
+            else:
+                word += next_letter
+                run = run + 1 if next_letter in songmaker.CONSONANTS else 0
+        return word, same_choices
+
+    def test_generate_words_matches_original_generator(self):
+        text = StringIO.StringIO('the quick brown fox jumps over the lazy dog ' * 10)
+        reader = songmaker.Reader(text)
+        reader.parse_text()
+        generator = songmaker.WordGenerator(reader, 3, 6, allow_doubles=False)
+        compared = 0
+        for seed in range(500):
+            word, same_choices = self.generate_word_by_letter(generator, random.Random(seed))
+            if not same_choices:
+                continue
+            self.assertEqual(generator.generate_words(1, random.Random(seed)), [word])
+            compared += 1
+        self.assertTrue(compared > 50, compared)
+
+    def test_generate_words_with_own_rng(self):
+        generator = songmaker.WordGenerator(self.reader, 3, 6, allow_doubles=False)
+        words = generator.generate_words(20, random.Random(7))
+        self.assertEqual(generator.generate_words(20, random.Random(7)), words)
+
+    def test_generate_word_pool_is_deterministic(self):
+        generator = songmaker.WordGenerator(self.reader, 3, 6, allow_doubles=False)
+        pool = songmaker.generate_word_pool(generator, 101, seed=5, num_workers=3)
+        self.assertEqual(len(pool), 101)
+        self.assertEqual(
+            songmaker.generate_word_pool(generator, 101, seed=5, num_workers=3), pool)
+
+    def test_generate_word_pool_single_worker(self):
+        generator = songmaker.WordGenerator(self.reader, 3, 6, allow_doubles=False)
+        pool = songmaker.generate_word_pool(generator, 30, seed=5, num_workers=1)
+        seed = random.Random(5).getrandbits(64)
+        self.assertEqual(pool, generator.generate_words(30, random.Random(seed)))
+
+    def test_generate_covering_pool(self):
+        generator = songmaker.WordGenerator(self.reader, 3, 6, allow_doubles=False)
+        pool = songmaker.generate_covering_pool(generator, 2, 1000,
+            min_syllables=1, max_syllables=2, seed=5, batch_size=10)
+        self.assertEqual(len(pool), len(set(pool)))
+        self.assertTrue(len(pool) < 1000)
+        song_writer = songmaker.SongWriter(pool)
+        song_writer.construct_maps()
+        covered = [group for group in song_writer.rhyme_groups if 1 in group and 2 in group]
+        self.assertTrue(len(covered) >= 2)
+        self.assertEqual(songmaker.generate_covering_pool(generator, 2, 1000,
+            min_syllables=1, max_syllables=2, seed=5, batch_size=10), pool)
+
+    def test_generate_covering_pool_stops_at_max_words(self):
+        generator = songmaker.WordGenerator(self.reader, 3, 6, allow_doubles=False)
+        pool = songmaker.generate_covering_pool(generator, 1000, 25, seed=5, batch_size=10)
+        self.assertEqual(len(pool), 25)
+        # most words have more than one syllable, so the last ones don't count
+        # towards any rhyme group
+        pool = songmaker.generate_covering_pool(generator, 1000, 25, min_syllables=1,
+            max_syllables=1, seed=0, batch_size=1000)
+        self.assertEqual(len(pool), 25)
+
+    def test_generate_covering_pool_stops_without_new_words(self):
+        reader = songmaker.Reader(StringIO.StringIO('ab ab ab'))
+        reader.parse_text()
+        generator = songmaker.WordGenerator(reader, 2, 2, allow_doubles=False)
+        pool = songmaker.generate_covering_pool(generator, 5, 1000, seed=1)
+        self.assertTrue(len(pool) < 1000)
+        self.assertEqual(len(pool), len(set(pool)))
+
+    def test_candidates_ordered_by_frequency_at_position(self):
+        generator = songmaker.WordGenerator(self.reader, 3, 6, allow_doubles=True)
+        followers = self.reader.following_letters('o', generator.follower_count)
+        expected = self.reader.specific_letters_at_position(
+            position=2, letters=followers)[:generator.position_limit]
+        self.assertEqual(generator.candidates[('o', 2)], expected)
+
+
 class TestSongWriter(unittest.TestCase):
     
     def test_construct_maps(self):
@@ -148,9 +388,78 @@ class TestSongWriter(unittest.TestCase):
             ['fish', 'dish', 'car', 'phone', 'tone'], song_writer.words_by_syllable[1])
         self.assertItemsEqual(['glombar'], song_writer.words_by_syllable[2])
         self.assertItemsEqual(['fantastish'], song_writer.words_by_syllable[3])
-        #print song_writer.rhyme_groups
-        #ish_group = [g for g in song_writer.rhyme_groups if 'fantastish' in g][0]
-        #self.assertItemsEqual(['fantastish', 'fish', 'dish'], ish_group)
+
+    def test_rhyme_groups(self):
+        words = ['fantastish', 'fish', 'dish', 'glombar', 'car', 'phone', 'tone', 'fish']
+        song_writer = songmaker.SongWriter(words)
+        song_writer.construct_maps()
+        self.assertItemsEqual(song_writer.rhyme_index.keys(), ['ish', 'ar', 'one'])
+        ish_group = song_writer.rhyme_index['ish']
+        self.assertItemsEqual(['fish', 'dish'], ish_group[1])
+        self.assertItemsEqual(['fantastish'], ish_group[3])
+        self.assertEqual(len(song_writer.rhyme_groups), 3)
+
+    def test_eligible_groups(self):
+        words = ['fantastish', 'fish', 'dish', 'glombar', 'car', 'phone', 'tone']
+        song_writer = songmaker.SongWriter(words)
+        song_writer.construct_maps()
+        self.assertItemsEqual(song_writer.eligible_groups[(1, 1)], ['ish', 'ar', 'one'])
+        self.assertItemsEqual(song_writer.eligible_groups[(1, 3)], ['ish'])
+        self.assertItemsEqual(song_writer.eligible_groups[(1, 2)], ['ar'])
+        self.assertFalse((2, 3) in song_writer.eligible_groups)
+
+    def test_get_song_uses_distinct_rhyme_groups(self):
+        words = ['fish', 'dish', 'car', 'bar', 'phone', 'tone']
+        song_writer = songmaker.SongWriter(words)
+        for i in range(20):
+            song = song_writer.get_song('1a,1a,1b,1b,1c', 1, 1)
+            suffixes = [songmaker.get_rhyme_suffix(line) for line in song]
+            self.assertEqual(suffixes[0], suffixes[1])
+            self.assertEqual(suffixes[2], suffixes[3])
+            self.assertEqual(len(set(suffixes)), 3)
+
+    def test_no_valid_rhyme_groups(self):
+        song_writer = songmaker.SongWriter(['fish', 'dish', 'car', 'bar'])
+        self.assertRaises(songmaker.NoValidRhymeGroupsFound,
+            song_writer.get_song, '1a,1b,1c', 1, 1)
+        self.assertRaises(songmaker.NoValidRhymeGroupsFound,
+            song_writer.get_song, '4a,4a', 1, 2)
+
+    def test_song_lines_have_scheme_syllables(self):
+        words = ['fish', 'dish', 'fantastish', 'glombar', 'car', 'bar', 'lovestar',
+            'phone', 'tone', 'telephone', 'baritone']
+        song_writer = songmaker.SongWriter(words)
+        for i in range(20):
+            song = song_writer.get_song('8a,8a,5b,5b,8a', 1, 3)
+            syllables = [sum(songmaker.count_syllables(w) for w in line.split())
+                for line in song]
+            self.assertEqual(syllables, [8, 8, 5, 5, 8])
+
+    def test_impossible_scheme_is_rejected(self):
+        song_writer = songmaker.SongWriter(['glombar', 'lovestar', 'phone', 'tone'])
+        self.assertRaises(songmaker.ImpossibleRhymingScheme,
+            song_writer.get_song, '5a,5a', 2, 2)
+        self.assertRaises(songmaker.ImpossibleRhymingScheme,
+            song_writer.get_song, '3a,3a', 4, 4)
+
+    def test_get_filler_table(self):
+        song_writer = songmaker.SongWriter(['glombar', 'lovestar', 'fantastish'])
+        song_writer.construct_maps()
+        fillers = song_writer.get_filler_table(7, 1, 4)
+        self.assertEqual(fillers, [[], [], [2], [3], [2], [2, 3], [2, 3], [2, 3]])
+
+    def test_get_rhyme_suffix(self):
+        self.assertEqual(songmaker.get_rhyme_suffix('fantastish'), 'ish')
+        self.assertEqual(songmaker.get_rhyme_suffix('phone'), 'one')
+        self.assertEqual(songmaker.get_rhyme_suffix('zwfqrns'), None)
+        self.assertEqual(songmaker.get_rhyme_suffix('free'), 'ee')
+        self.assertEqual(songmaker.get_rhyme_suffix('the'), None)
+
+    def test_get_rhyme_suffix_of_long_word(self):
+        cache_size = len(songmaker.syllable_cache.current)
+        self.assertEqual(songmaker.get_rhyme_suffix('a' + 'b' * 8000 + 'e'), 'a' + 'b' * 8000 + 'e')
+        self.assertEqual(songmaker.get_rhyme_suffix('b' * 8000), None)
+        self.assertEqual(len(songmaker.syllable_cache.current), cache_size)
 
     def test_get_parsed_rhyming_scheme(self):
         song_writer = songmaker.SongWriter([])
@@ -158,6 +467,715 @@ class TestSongWriter(unittest.TestCase):
         parsed_scheme = song_writer.get_parsed_rhyming_scheme(raw_scheme)
         self.assertEqual(parsed_scheme, [(8, 'a'), (12, 'b'), (1, 'c'), (100, 'a')])
 
+    def test_get_rhymes(self):
+        words = ['fish', 'dish', 'fantastish', 'outlandish', 'glombar', 'car', 'phone']
+        song_writer = songmaker.SongWriter(words)
+        rhymes, total = song_writer.get_rhymes('swish')
+        self.assertEqual(total, 4)
+        self.assertEqual(rhymes, {1: ['fish', 'dish'], 3: ['fantastish', 'outlandish']})
+        self.assertEqual(song_writer.get_rhymes('wish', offset=1, limit=2),
+            ({1: ['dish'], 3: ['fantastish']}, 4))
+        self.assertEqual(song_writer.get_rhymes('wish', offset=4), ({}, 4))
+        self.assertEqual(song_writer.get_rhymes('zwfqrns'), ({}, 0))
+
+    def test_get_rhymes_from_snapshot(self):
+        words = ['fish', 'dish', 'fantastish', 'glombar', 'car', 'phone']
+        song_writer = songmaker.SongWriter(words)
+        path = os.path.join(tempfile.mkdtemp(), 'rhymes.model')
+        try:
+            song_writer.save(path)
+            loaded = songmaker.SongWriter.load(path)
+            self.assertEqual(loaded.get_rhymes('star', 1, 5), song_writer.get_rhymes('star', 1, 5))
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_get_song_with_own_rng(self):
+        words = ['fish', 'dish', 'fantastish', 'glombar', 'car', 'bar', 'lovestar',
+            'phone', 'tone', 'telephone', 'baritone']
+        song_writer = songmaker.SongWriter(words)
+        song = song_writer.get_song('5a,5a,3b', 1, 3, random.Random(11))
+        self.assertEqual(song_writer.get_song('5a,5a,3b', 1, 3, random.Random(11)), song)
+
+    def test_retries(self):
+        song_writer = songmaker.SongWriter(['fish', 'dish', 'car', 'bar'])
+        failures = [songmaker.NoValidRhymeGroupsFound()] * 2
+        def compose_song(*args):
+            if failures:
+                raise failures.pop()
+            return ['a song']
+        song_writer.compose_song = compose_song
+        self.assertRaises(songmaker.NoValidRhymeGroupsFound,
+            song_writer.get_song, '1a', 1, 1, retries=1)
+        failures.extend([songmaker.NoValidRhymeGroupsFound()] * 2)
+        self.assertEqual(song_writer.get_song('1a', 1, 1, retries=2), ['a song'])
+
+    def test_deadline(self):
+        song_writer = songmaker.SongWriter(['fish', 'dish', 'car', 'bar'])
+        songs = song_writer.get_songs('1a', 3, 1, 1, deadline=time.time() - 1)
+        self.assertRaises(songmaker.DeadlineExceeded, list, songs)
+
+    def test_threads_share_a_writer(self):
+        words = ['fish', 'dish', 'fantastish', 'glombar', 'car', 'bar', 'lovestar',
+            'phone', 'tone', 'telephone', 'baritone']
+        song_writer = songmaker.SongWriter(words)
+        expected = list(songmaker.SongWriter(words).get_songs(
+            '8a,8a,5b,5b,8a', 50, 1, 3, random.Random(3)))
+        results = []
+        def write_songs():
+            results.append(list(song_writer.get_songs(
+                '8a,8a,5b,5b,8a', 50, 1, 3, random.Random(3))))
+        # the first songs also race to construct the maps
+        threads = [threading.Thread(target=write_songs) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [expected] * 8)
+
+
+class TestIncrementalUpdates(unittest.TestCase):
+
+    def setUp(self):
+        self.song_writer = songmaker.SongWriter(['fish', 'dish', 'glombar', 'car', 'fish'])
+        self.song_writer.construct_maps()
+
+    def assert_same_maps(self, song_writer, words):
+        rebuilt = songmaker.SongWriter(words)
+        rebuilt.construct_maps()
+        self.assertItemsEqual(song_writer.all_words, rebuilt.all_words)
+        self.assertItemsEqual(song_writer.words_by_syllable.keys(), rebuilt.words_by_syllable.keys())
+        for syllables, bucket in rebuilt.words_by_syllable.items():
+            self.assertItemsEqual(song_writer.words_by_syllable[syllables], bucket)
+        self.assertItemsEqual(song_writer.rhyme_index.keys(), rebuilt.rhyme_index.keys())
+        for suffix, group in rebuilt.rhyme_index.items():
+            self.assertItemsEqual(song_writer.rhyme_index[suffix].keys(), group.keys())
+            for syllables, bucket in group.items():
+                self.assertItemsEqual(song_writer.rhyme_index[suffix][syllables], bucket)
+        self.assertEqual(len(song_writer.rhyme_groups), len(rebuilt.rhyme_groups))
+        eligible_groups = rebuilt.get_eligible_groups()
+        self.assertItemsEqual(song_writer.eligible_groups.keys(), eligible_groups.keys())
+        for key, suffixes in eligible_groups.items():
+            self.assertItemsEqual(song_writer.eligible_groups[key], suffixes)
+
+    def test_add_words(self):
+        self.song_writer.add_words(['phone', 'fantastish', 'tone'])
+        self.assert_same_maps(self.song_writer,
+            ['fish', 'dish', 'glombar', 'car', 'fish', 'phone', 'fantastish', 'tone'])
+
+    def test_remove_words(self):
+        self.song_writer.remove_words(['fish', 'car', 'glombar'])
+        self.assert_same_maps(self.song_writer, ['fish', 'dish'])
+        self.song_writer.remove_words(['fish'])
+        self.assert_same_maps(self.song_writer, ['dish'])
+
+    def test_remove_missing_word(self):
+        self.assertRaises(ValueError, self.song_writer.remove_words, ['phone'])
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'test.model')
+        words = ['fantastish', 'fish', 'dish', 'glombar', 'car', 'phone', 'tone', 'fish']
+        self.song_writer = songmaker.SongWriter(words)
+        self.song_writer.save(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_load_restores_maps(self):
+        loaded = songmaker.SongWriter.load(self.path)
+        self.assertEqual(list(loaded.all_words), list(self.song_writer.all_words))
+        for syllables, words in self.song_writer.words_by_syllable.items():
+            self.assertEqual(list(loaded.words_by_syllable[syllables]), list(words))
+        self.assertEqual(len(loaded.rhyme_groups), len(self.song_writer.rhyme_groups))
+        for original, group in zip(self.song_writer.rhyme_groups, loaded.rhyme_groups):
+            self.assertItemsEqual(original.keys(), group.keys())
+            for syllables in original:
+                self.assertEqual(list(group[syllables]), list(original[syllables]))
+        self.assertItemsEqual(loaded.rhyme_index.keys(), self.song_writer.rhyme_index.keys())
+
+    def test_loaded_song_writer_writes_songs(self):
+        loaded = songmaker.SongWriter.load(self.path)
+        song = loaded.get_song('1a,1a,1b,1b', 1, 1)
+        self.assertEqual(len(song), 4)
+
+    def test_loaded_song_writer_writes_same_songs(self):
+        # phone and tone go in before bar and car, so insertion order isn't sorted
+        words = ['phone', 'tone', 'wish', 'fish', 'glombar', 'car', 'bar', 'dish']
+        built = songmaker.SongWriter(words)
+        built.save(self.path)
+        loaded = songmaker.SongWriter.load(self.path)
+        for seed in range(20):
+            self.assertEqual(
+                built.get_song('1a,1a,1b,1b', 1, 1, rng=random.Random(seed)),
+                loaded.get_song('1a,1a,1b,1b', 1, 1, rng=random.Random(seed)))
+        built.add_words(['cone', 'lash', 'bash'])
+        built.save(self.path)
+        loaded = songmaker.SongWriter.load(self.path)
+        for seed in range(20):
+            self.assertEqual(
+                built.get_song('1a,1a,1b,1b', 1, 1, rng=random.Random(seed)),
+                loaded.get_song('1a,1a,1b,1b', 1, 1, rng=random.Random(seed)))
+
+    def test_loaded_song_writer_can_be_updated(self):
+        loaded = songmaker.SongWriter.load(self.path)
+        loaded.remove_words(['fish', 'fish'])
+        loaded.add_words(['bash'])
+        self.assertItemsEqual(loaded.rhyme_index['ish'][1], ['dish'])
+        self.assertItemsEqual(loaded.rhyme_index['ash'][1], ['bash'])
+
+    def test_load_rejects_other_files(self):
+        with open(self.path, 'wb') as other_file:
+            other_file.write('not a model at all')
+        self.assertRaises(ValueError, songmaker.SongWriter.load, self.path)
+
+    def test_load_rejects_truncated_snapshot(self):
+        with open(self.path, 'rb') as snapshot_file:
+            data = snapshot_file.read()
+        for length in (songmaker.SNAPSHOT_HEADER.size, len(data) - 1):
+            with open(self.path, 'wb') as snapshot_file:
+                snapshot_file.write(data[:length])
+            self.assertRaises(ValueError, songmaker.SongWriter.load, self.path)
+
+    def test_save_leaves_no_temporary_files(self):
+        self.song_writer.save(self.path)
+        self.assertEqual(os.listdir(self.temp_dir), ['test.model'])
+        self.assertEqual(os.stat(self.path).st_mode & 0777, 0644)
+
+
+class TestSongBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.song_writer = songmaker.SongWriter(['fish', 'dish', 'car', 'bar', 'phone', 'tone'])
+        self.buffer = songservice.SongBuffer(
+            self.write_songs, max_keys=2, songs_per_key=3, max_bytes=10000)
+
+    def write_songs(self, key, count):
+        scheme, min_syllables, max_syllables = key
+        return list(self.song_writer.get_songs(scheme, count, min_syllables, max_syllables))
+
+    def test_key_buffered_on_second_request(self):
+        key = ('1a,1a', 1, 1)
+        self.assertEqual(self.buffer.get_song(key), None)
+        self.assertFalse(key in self.buffer.buffers)
+        self.assertEqual(self.buffer.get_song(key), None)
+        self.buffer.refill()
+        self.assertEqual(len(self.buffer.buffers[key]), 3)
+        self.assertEqual(len(self.buffer.get_song(key)), 2)
+        self.assertEqual(len(self.buffer.buffers[key]), 2)
+
+    def test_least_recently_used_key_evicted(self):
+        keys = [('1a', 1, 1), ('1a,1b', 1, 1), ('1a,1b,1c', 1, 1)]
+        self.buffer.preload(keys[:2])
+        self.buffer.get_song(keys[0])
+        self.buffer.preload(keys[2:])
+        self.assertEqual(self.buffer.buffers.keys(), [keys[0], keys[2]])
+
+    def test_impossible_key_dropped(self):
+        self.buffer.preload([('5a', 2, 2)])
+        self.buffer.refill()
+        self.assertEqual(len(self.buffer.buffers), 0)
+
+    def test_long_songs_limited_by_bytes(self):
+        written = []
+        def write_songs(key, count):
+            written.append(count)
+            return self.write_songs(key, count)
+        buffer = songservice.SongBuffer(write_songs, max_keys=2, songs_per_key=100, max_bytes=8000)
+        key = ('100a,100a', 1, 1)
+        buffer.preload([key])
+        buffer.refill()
+        song_size = songservice.get_song_size(buffer.buffers[key][0])
+        self.assertTrue(song_size > 800)
+        self.assertEqual(len(buffer.buffers[key]), 4000 / song_size)
+        self.assertTrue(buffer.buffered_bytes[key] <= 4000)
+        # one song to learn the size, then only what fits
+        self.assertEqual(written, [1, 4000 / song_size - 1])
+        buffer.get_song(key)
+        buffer.refill()
+        self.assertEqual(written[2:], [1])
+
+
+class TestLoadModel(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = (songservice.MODEL_DIR, songservice.WORD_POOL_SIZE,
+            songservice.WORD_POOL_RHYME_GROUPS)
+        songservice.MODEL_DIR = tempfile.mkdtemp()
+        songservice.WORD_POOL_SIZE, songservice.WORD_POOL_RHYME_GROUPS = 2000, 5
+
+    def tearDown(self):
+        shutil.rmtree(songservice.MODEL_DIR)
+        (songservice.MODEL_DIR, songservice.WORD_POOL_SIZE,
+            songservice.WORD_POOL_RHYME_GROUPS) = self.settings
+
+    def test_snapshot_named_after_pool_settings(self):
+        path = songservice.get_snapshot_path('metamorphosis', 4, 9)
+        songservice.WORD_POOL_SIZE = 3000
+        self.assertNotEqual(songservice.get_snapshot_path('metamorphosis', 4, 9), path)
+
+    def test_load_model_saves_and_reuses_snapshot(self):
+        song_writer = songservice.load_model('metamorphosis', 4, 9)
+        path = songservice.get_snapshot_path('metamorphosis', 4, 9)
+        self.assertEqual(os.listdir(songservice.MODEL_DIR), [os.path.basename(path)])
+        words = list(song_writer.all_words)
+        os.utime(path, (0, 0))
+        self.assertEqual(list(songservice.load_model('metamorphosis', 4, 9).all_words), words)
+        self.assertEqual(os.stat(path).st_mtime, 0)
+
+    def test_unreadable_snapshot_rebuilt(self):
+        path = songservice.get_snapshot_path('metamorphosis', 4, 9)
+        with open(path, 'wb') as snapshot_file:
+            snapshot_file.write('SONGMDL1 but cut short')
+        song_writer = songservice.load_model('metamorphosis', 4, 9)
+        self.assertTrue(len(song_writer.all_words) > 0)
+        self.assertTrue(os.path.getsize(path) > 100)
+
+    def test_model_kept_in_memory_when_snapshot_cant_be_saved(self):
+        model_dir = songservice.MODEL_DIR
+        songservice.MODEL_DIR = os.path.join(model_dir, 'missing')
+        try:
+            song_writer = songservice.load_model('metamorphosis', 4, 9)
+        finally:
+            songservice.MODEL_DIR = model_dir
+        self.assertTrue(len(song_writer.all_words) > 0)
+        # the in-memory model, not one loaded back from a snapshot
+        self.assertIsNotNone(song_writer.word_counts)
+
+
+class TestModelRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.loaded_keys = []
+        self.registry = songservice.ModelRegistry(self.load_model, memory_budget=5000)
+
+    def load_model(self, *key):
+        self.loaded_keys.append(key)
+        return songmaker.SongWriter(['fish'] * 5)
+
+    def test_model_loaded_once(self):
+        song_writer = self.registry.get(('a', 4, 9))
+        self.assertTrue(self.registry.get(('a', 4, 9)) is song_writer)
+        self.assertEqual(self.loaded_keys, [('a', 4, 9)])
+
+    def test_least_recently_used_model_evicted(self):
+        for key in [('a', 4, 9), ('b', 4, 9), ('a', 4, 9), ('c', 4, 9)]:
+            self.registry.get(key)
+        self.assertEqual(self.registry.models.keys(), [('a', 4, 9), ('c', 4, 9)])
+
+    def test_replace_swaps_in_new_model(self):
+        old_model = self.registry.get(('a', 4, 9))
+        served = []
+        def load_model(*key):
+            # requests still get the old model while the new one loads
+            served.append(self.registry.get(key))
+            return songmaker.SongWriter(['dish'] * 5)
+        self.registry.load_model = load_model
+        new_model = self.registry.replace(('a', 4, 9))
+        self.assertEqual(served, [old_model])
+        self.assertFalse(new_model is old_model)
+        self.assertTrue(self.registry.get(('a', 4, 9)) is new_model)
+        self.assertEqual(new_model.first_time, False)
+
+
+class TestAdmissionQueue(unittest.TestCase):
+
+    def test_admit(self):
+        admission_queue = songservice.AdmissionQueue(2, 0, 0)
+        self.assertTrue(admission_queue.admit())
+        self.assertTrue(admission_queue.admit())
+        self.assertFalse(admission_queue.admit())
+        admission_queue.release()
+        self.assertTrue(admission_queue.admit())
+
+    def test_waiting(self):
+        admission_queue = songservice.AdmissionQueue(1, 1, 5)
+        self.assertTrue(admission_queue.admit())
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(admission_queue.admit()))
+        waiter.start()
+        while admission_queue.waiting == 0:
+            time.sleep(0.001)
+        # the queue is full, so another request is turned away straight away
+        self.assertFalse(admission_queue.admit())
+        admission_queue.release()
+        waiter.join()
+        self.assertEqual(results, [True])
+        self.assertEqual(admission_queue.in_flight, 1)
+
+    def test_wait_times_out(self):
+        admission_queue = songservice.AdmissionQueue(1, 1, 0.01)
+        self.assertTrue(admission_queue.admit())
+        self.assertFalse(admission_queue.admit())
+        self.assertEqual(admission_queue.waiting, 0)
+
+
+class TestWarmUp(unittest.TestCase):
+
+    def setUp(self):
+        self.client = songservice.app.test_client()
+
+    def tearDown(self):
+        songservice.ready.clear()
+        songservice.warm_up_failed.clear()
+
+    def test_ready(self):
+        self.assertEqual(self.client.get('/healthz').status_code, 200)
+        resp = self.client.get('/ready')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '1')
+        songservice.ready.set()
+        self.assertEqual(self.client.get('/ready').status_code, 200)
+
+    def test_failed_warm_up(self):
+        preload_corpora = songservice.PRELOAD_CORPORA
+        songservice.PRELOAD_CORPORA = ['nosuchbook']
+        try:
+            songservice.warm_up(0)
+        finally:
+            songservice.PRELOAD_CORPORA = preload_corpora
+        self.assertEqual(self.client.get('/healthz').status_code, 500)
+        self.assertEqual(self.client.get('/ready').status_code, 503)
+
+    def run_main(self, background):
+        model_key = (songservice.DEFAULT_CORPUS, songservice.MIN_LETTERS, songservice.MAX_LETTERS)
+        songservice.models.add(model_key, songmaker.SongWriter(['fish', 'dish', 'car', 'bar']))
+        song_buffer = songservice.song_buffer
+        songservice.song_buffer = songservice.SongBuffer(lambda key, count: [], 4, 1, 1024)
+        try:
+            songservice.main(background=background)
+            if background:
+                self.assertTrue(songservice.ready.wait(5))
+            else:
+                self.assertTrue(songservice.ready.is_set())
+            self.assertItemsEqual(songservice.song_buffer.buffers.keys(),
+                [songservice.get_song_key(model_key, *preset)
+                    for preset in songservice.PRESET_SCHEMES])
+        finally:
+            songservice.song_buffer = song_buffer
+            songservice.models.models.clear()
+
+    def test_main_warms_up_in_background(self):
+        self.run_main(background=True)
+
+    def test_main_can_warm_up_before_returning(self):
+        self.run_main(background=False)
+
+
+class TestSongService(unittest.TestCase):
+
+    def setUp(self):
+        words = ['fish', 'dish', 'fantastish', 'glombar', 'car', 'bar', 'lovestar',
+            'phone', 'tone', 'telephone', 'baritone']
+        self.model_key = ('metamorphosis', songservice.MIN_LETTERS, songservice.MAX_LETTERS)
+        songservice.models.add(self.model_key, songmaker.SongWriter(words))
+        self.client = songservice.app.test_client()
+
+    def tearDown(self):
+        songservice.models.models.clear()
+
+    def test_get_song(self):
+        resp = self.client.get('/?scheme=8a,8a,5b,5b,8a&minSyllables=1&maxSyllables=3')
+        self.assertEqual(len(json.loads(resp.data)['songlines']), 5)
+        self.assertEqual(resp.headers['Access-Control-Allow-Origin'], '*')
+
+    def test_get_songs_streams_ndjson(self):
+        resp = self.client.get('/songs?scheme=8a,8a,5b&maxSyllables=3&count=7')
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        lines = resp.data.splitlines()
+        self.assertEqual(len(lines), 7)
+        for line in lines:
+            self.assertEqual(len(json.loads(line)['songlines']), 3)
+
+    def test_get_song_from_buffer(self):
+        key = songservice.get_song_key(self.model_key, '1a, 1b', 1, 1)
+        self.assertEqual(key, (self.model_key, '1a,1b', 1, 1))
+        song_buffer = songservice.song_buffer
+        song_buffer.preload([key])
+        song_buffer.buffers[key].append(['buffered', 'song'])
+        song_buffer.buffered_bytes[key] += 12
+        try:
+            resp = self.client.get('/?scheme=1a, 1b&minSyllables=1&maxSyllables=1')
+            self.assertEqual(json.loads(resp.data)['songlines'], ['buffered', 'song'])
+            self.assertEqual(song_buffer.buffered_bytes[key], 0)
+        finally:
+            song_buffer.remove_key(key)
+
+    def test_seeded_song(self):
+        url = '/?scheme=8a,8a,5b,5b,8a&minSyllables=1&maxSyllables=3&seed=12'
+        resp = self.client.get(url)
+        self.assertEqual(self.client.get(url).data, resp.data)
+        self.assertIn('max-age', resp.headers['Cache-Control'])
+        etag = resp.headers['ETag']
+        self.assertFalse(etag.startswith('W/'))
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_unseeded_song_is_not_cached(self):
+        resp = self.client.get('/?scheme=8a,8a,5b&maxSyllables=3')
+        self.assertEqual(resp.headers['Cache-Control'], 'no-store')
+        self.assertNotIn('ETag', resp.headers)
+
+    def test_bad_seed(self):
+        resp = self.client.get('/?scheme=8a&seed=abc')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_redirect_to_seeded_song(self):
+        resp = self.client.get('/?scheme=8a,8a,5b&maxSyllables=3&redirect=seeded')
+        self.assertEqual(resp.status_code, 302)
+        location = urlparse.urlsplit(resp.headers['Location'])
+        location = '%s?%s' % (location.path, location.query)
+        self.assertIn('seed=', location)
+        self.assertNotIn('redirect=', location)
+        self.assertIn('scheme=8a%2C8a%2C5b', location)
+        self.assertEqual(self.client.get(location).status_code, 200)
+
+    def test_get_rhymes(self):
+        resp = self.client.get('/rhymes?word=Wish&limit=1')
+        body = json.loads(resp.data)
+        self.assertEqual(body['suffix'], 'ish')
+        self.assertEqual(body['total'], 3)
+        self.assertEqual(body['rhymes'], {'1': ['fish']})
+        resp = self.client.get(body['next'])
+        self.assertEqual(json.loads(resp.data)['rhymes'], {'1': ['dish']})
+
+    def test_get_rhymes_of_bad_word(self):
+        self.assertEqual(self.client.get('/rhymes?word=no rhyme').status_code, 400)
+        self.assertEqual(self.client.get('/rhymes?word=fish&limit=x').status_code, 400)
+        self.assertEqual(self.client.get('/rhymes?word=fish%0A').status_code, 400)
+        long_word = 'b' * (songservice.MAX_RHYME_WORD_LENGTH + 1)
+        self.assertEqual(self.client.get('/rhymes?word=' + long_word).status_code, 400)
+        self.assertEqual(self.client.get('/rhymes?word=fish&limit=0').status_code, 400)
+        self.assertEqual(self.client.get('/rhymes?word=fish&limit=-1').status_code, 400)
+
+    def test_bad_rhymes_request_doesnt_load_model(self):
+        songservice.models.models.clear()
+        load_model = songservice.models.load_model
+        songservice.models.load_model = self.fail
+        try:
+            self.assertEqual(self.client.get('/rhymes?word=no rhyme').status_code, 400)
+        finally:
+            songservice.models.load_model = load_model
+
+    def test_bad_song_parameters(self):
+        for query in ['', 'scheme=', 'scheme=nonsense', 'scheme=0a', 'scheme=101a',
+                'scheme=' + '1a,' * 101, 'scheme=8a&minSyllables=x',
+                'scheme=8a&minSyllables=0', 'scheme=8a&maxSyllables=11']:
+            self.assertEqual(self.client.get('/?' + query).status_code, 400, query)
+            self.assertEqual(self.client.get('/songs?' + query).status_code, 400, query)
+        self.assertEqual(self.client.get('/songs?scheme=8a&count=x').status_code, 400)
+        self.assertEqual(self.client.get('/songs?scheme=8a&count=0').status_code, 400)
+        self.assertEqual(self.client.get('/songs?scheme=8a&count=-3').status_code, 400)
+
+    def test_busy(self):
+        admission_queue = songservice.admission_queue
+        songservice.admission_queue = songservice.AdmissionQueue(0, 0, 0)
+        try:
+            resp = self.client.get('/?scheme=8a,8a,5b&maxSyllables=3')
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.headers['Retry-After'], '1')
+            self.assertEqual(self.client.get('/healthz').status_code, 200)
+        finally:
+            songservice.admission_queue = admission_queue
+
+    def test_unknown_corpus(self):
+        resp = self.client.get('/?scheme=8a&corpus=nosuchbook')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_get_songs_with_impossible_scheme(self):
+        resp = self.client.get('/songs?scheme=5a&minSyllables=2&maxSyllables=2&count=3')
+        self.assertEqual(json.loads(resp.data)['songlines'],
+            ['could not create a song with those parameters'])
+
+    def test_metrics(self):
+        self.client.get('/?scheme=8a,8a,5b,5b,8a&minSyllables=1&maxSyllables=3')
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('# TYPE songmaker_songs_written_total counter', resp.data)
+        self.assertIn('songservice_requests_total{route="/",status="200"}', resp.data)
+        self.assertIn('songservice_request_seconds_count{route="/"}', resp.data)
+
+    def test_metrics_record_unhandled_errors(self):
+        # a model without get_rhymes makes /rhymes raise
+        songservice.models.models[self.model_key] = object()
+        resp = self.client.get('/rhymes?word=fish')
+        self.assertEqual(resp.status_code, 500)
+        resp = self.client.get('/metrics')
+        self.assertIn('songservice_requests_total{route="/rhymes",status="500"}', resp.data)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def tearDown(self):
+        del metrics.all_metrics[-1]
+
+    def test_counter(self):
+        counter = metrics.Counter('test_total', 'A test counter', ['kind'])
+        counter.inc(labels=('a',))
+        counter.inc(2, labels=('a',))
+        self.assertEqual(counter.render(), ['# HELP test_total A test counter',
+            '# TYPE test_total counter', 'test_total{kind="a"} 3.0'])
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_seconds', 'A test histogram', buckets=(1, 2))
+        histogram.observe(0.5)
+        histogram.observe(1.5)
+        histogram.observe(5)
+        self.assertEqual(histogram.render()[2:], ['test_seconds_bucket{le="1"} 1',
+            'test_seconds_bucket{le="2"} 2', 'test_seconds_bucket{le="+Inf"} 3',
+            'test_seconds_sum 7.0', 'test_seconds_count 3'])
+
+
+class TestStaticAssets(unittest.TestCase):
+
+    def setUp(self):
+        songservice.static_assets.load()
+        self.client = songservice.app.test_client()
+
+    def tearDown(self):
+        songservice.static_assets.assets = {}
+
+    def test_pages_link_to_versioned_assets(self):
+        resp = self.client.get('/index.html')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+        css = songservice.static_assets.assets['bootstrap/css/bootstrap.min.css']
+        self.assertIn('href="bootstrap/css/bootstrap.min.css?v=%s"' % css.version, resp.data)
+        self.assertIn('src="songmaker.js?v=', resp.data)
+
+    def test_versioned_asset_is_cached_for_good(self):
+        asset = songservice.static_assets.assets['songmaker.js']
+        resp = self.client.get('/songmaker.js?v=%s' % asset.version)
+        self.assertEqual(resp.data, asset.data)
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+
+    def test_gzip(self):
+        resp = self.client.get('/bootstrap/css/bootstrap.css',
+            headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        with open('bootstrap/css/bootstrap.css', 'rb') as css_file:
+            expected = css_file.read()
+        gzip_file = gzip.GzipFile(fileobj=StringIO.StringIO(resp.data))
+        self.assertEqual(gzip_file.read(), expected)
+
+    def test_gzip_refused(self):
+        resp = self.client.get('/bootstrap/css/bootstrap.css',
+            headers={'Accept-Encoding': 'gzip;q=0, identity'})
+        self.assertFalse('Content-Encoding' in resp.headers)
+
+    def test_not_modified(self):
+        etag = self.client.get('/schemebuilder.html').headers['ETag']
+        resp = self.client.get('/schemebuilder.html', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, '')
+
+    def test_unknown_file(self):
+        self.assertEqual(self.client.get('/songservice.py').status_code, 404)
+        self.assertEqual(self.client.get('/bootstrap/../tests.py').status_code, 404)
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stack_sampler(self):
+        sampler = profiling.StackSampler(interval=0.001)
+        sampler.start()
+        try:
+            end_time = time.clock() + 0.2
+            while time.clock() < end_time:
+                songmaker.scan_syllables('fantastish')
+        finally:
+            sampler.stop()
+        path = os.path.join(self.directory, 'run.folded')
+        sampler.write(path)
+        with open(path, 'r') as folded_file:
+            lines = folded_file.read().splitlines()
+        self.assertTrue(lines)
+        self.assertTrue(any('test_stack_sampler (tests.py:' in line for line in lines))
+        self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit() for line in lines))
+
+    def test_dump_request_profile_rotates(self):
+        for i in range(5):
+            profiler = cProfile.Profile()
+            profiler.runcall(songmaker.count_syllables, 'fish')
+            profiling.dump_request_profile(profiler, self.directory, 'get_song', 3)
+        dumps = os.listdir(self.directory)
+        self.assertEqual(len(dumps), 3)
+        pstats.Stats(os.path.join(self.directory, dumps[0]))
+
+    def test_sampled_requests(self):
+        songservice.models.add(('metamorphosis', songservice.MIN_LETTERS,
+            songservice.MAX_LETTERS), songmaker.SongWriter(['fish', 'dish', 'car', 'bar']))
+        profile_settings = songservice.PROFILE_EVERY, songservice.PROFILE_DIR
+        songservice.PROFILE_EVERY, songservice.PROFILE_DIR = 2, self.directory
+        try:
+            client = songservice.app.test_client()
+            for i in range(4):
+                client.get('/rhymes?word=wish')
+        finally:
+            songservice.PROFILE_EVERY, songservice.PROFILE_DIR = profile_settings
+            songservice.models.models.clear()
+        dumps = os.listdir(self.directory)
+        self.assertEqual(len(dumps), 2)
+        self.assertTrue(all(dump.endswith('-get_rhymes.pstats') for dump in dumps))
+
+    def test_sampled_request_that_raises(self):
+        # a model without get_rhymes makes /rhymes raise
+        songservice.models.models[('metamorphosis', songservice.MIN_LETTERS,
+            songservice.MAX_LETTERS)] = object()
+        profile_settings = songservice.PROFILE_EVERY, songservice.PROFILE_DIR
+        songservice.PROFILE_EVERY, songservice.PROFILE_DIR = 1, self.directory
+        try:
+            resp = songservice.app.test_client().get('/rhymes?word=wish')
+        finally:
+            songservice.PROFILE_EVERY, songservice.PROFILE_DIR = profile_settings
+            songservice.models.models.clear()
+        self.assertEqual(resp.status_code, 500)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        # the profiler was stopped, so the next function call isn't in it
+        self.assertEqual(sys.getprofile(), None)
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_summarise(self):
+        summary = benchmark.summarise([0.1 * i for i in range(1, 11)])
+        self.assertEqual(summary['iterations'], 10)
+        self.assertAlmostEqual(summary['p50'], 0.6)
+        self.assertAlmostEqual(summary['max'], 1.0)
+
+    def test_compare_flags_regressions(self):
+        baseline = {'fast': {'p50': 1.0}, 'slow': {'p50': 1.0}}
+        results = {'fast': {'p50': 1.1}, 'slow': {'p50': 1.5}, 'new': {'p50': 9.0}}
+        self.assertEqual(benchmark.compare(results, baseline, tolerance=0.2), ['slow'])
+
+    def test_compare_flags_memory_regressions(self):
+        baseline = {'small': {'p50': 1.0, 'memory_kb': 100},
+            'big': {'p50': 1.0, 'memory_kb': 50000}}
+        results = {'small': {'p50': 1.0, 'memory_kb': 900},
+            'big': {'p50': 1.0, 'memory_kb': 80000}}
+        self.assertEqual(benchmark.compare(results, baseline, tolerance=0.2), ['big'])
+
+    def test_measure_in_child(self):
+        def allocate():
+            return len('x' * (20 * 1024 * 1024))
+        summary = benchmark.run_in_child(lambda: benchmark.measure(allocate, 1))
+        self.assertEqual(summary['iterations'], 1)
+        self.assertTrue(summary['memory_kb'] >= 15 * 1024, summary)
+        # the next benchmark starts from its own baseline
+        summary = benchmark.run_in_child(lambda: benchmark.measure(lambda: None, 1))
+        self.assertTrue(summary['memory_kb'] < 1024, summary)
+
+    def test_failing_child(self):
+        self.assertRaises(RuntimeError, benchmark.run_in_child, lambda: 1 / 0)
+
 
 if __name__ == '__main__':
     unittest.main()